@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+
+"""archive.py
+
+Udacity conference server-side Python App Engine archival of ended
+    conferences; moves them to the "archive" namespace so live queries
+    only scan current data
+
+An archived Conference keeps its kind, key path and properties, so the
+same filters (and composite indexes) work against the archive. Its
+sessions are packed into one compressed ArchivedSessions entity and no
+longer appear in the global session queries.
+
+$Id$
+
+"""
+
+from datetime import date, datetime, timedelta
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+import facets
+from models import ArchivedSessions
+from models import Conference
+from models import Session
+from models import Tombstone
+from models import WaitlistEntry
+
+ARCHIVE_NAMESPACE = 'archive'
+ARCHIVE_BATCH_SIZE = 50
+# clients that last synced longer ago than this must fetch everything
+TOMBSTONE_RETENTION = timedelta(days=30)
+
+SESSION_FIELDS = ('name', 'highlights', 'speaker', 'typeOfSession',
+                  'duration')
+
+
+def archive_key(key):
+    """Return the key key would have in the archive namespace."""
+    return ndb.Key(flat=key.flat(), namespace=ARCHIVE_NAMESPACE)
+
+
+def is_archived(key):
+    return key.namespace() == ARCHIVE_NAMESPACE
+
+
+def get(key):
+    """Like key.get(), falling back to the archive."""
+    return get_multi([key])[0]
+
+
+def get_multi(keys):
+    """Like ndb.get_multi(), looking up keys that are no longer live in
+    the archive; entities found in neither are None."""
+    entities = ndb.get_multi(keys)
+    missing = [i for i, entity in enumerate(entities)
+               if entity is None and not is_archived(keys[i])]
+    if missing:
+        archived = ndb.get_multi([archive_key(keys[i]) for i in missing])
+        for i, entity in zip(missing, archived):
+            entities[i] = entity
+    return entities
+
+
+def _pack_session(session):
+    data = dict((field, getattr(session, field)) for field in SESSION_FIELDS)
+    data['id'] = session.key.id()
+    data['date'] = session.date.isoformat() if session.date else None
+    data['startTime'] = (session.startTime.strftime('%H:%M')
+                         if session.startTime else None)
+    return data
+
+
+def _unpack_session(data, c_key):
+    data = dict(data)
+    s_key = ndb.Key(Session, data.pop('id'), parent=c_key)
+    if data['date']:
+        data['date'] = datetime.strptime(data['date'], '%Y-%m-%d').date()
+    if data['startTime']:
+        data['startTime'] = datetime.strptime(data['startTime'],
+                                              '%H:%M').time()
+    return Session(key=s_key, **data)
+
+
+def get_sessions(c_key):
+    """Return the (unsaved) Session objects of an archived conference."""
+    packed = ArchivedSessions.key_for(c_key).get()
+    if not packed:
+        return []
+    return [_unpack_session(data, c_key) for data in packed.sessions]
+
+
+@ndb.transactional(xg=True)
+def archive_conference(c_key):
+    """Move one conference and its sessions into the archive."""
+    conf = c_key.get()
+    if not conf:
+        return False
+    a_key = archive_key(c_key)
+    sessions = Session.query(ancestor=c_key).fetch()
+
+    archived = Conference(key=a_key, **conf.to_dict(exclude=['updated']))
+    packed = ArchivedSessions(key=ArchivedSessions.key_for(a_key),
+                              sessions=[_pack_session(s) for s in sessions])
+    deleted = [c_key] + [s.key for s in sessions]
+    tombstone = Tombstone(websafeKeys=[key.urlsafe() for key in deleted])
+    ndb.put_multi([archived, packed, tombstone])
+    ndb.delete_multi(deleted)
+    # facets describe the live conferences, as default queries do
+    facets.enqueue(facets.deltas_for(conf, 'conferences', -1) +
+                   facets.deltas_for(conf, 'registrations',
+                                     -facets.registered(conf)),
+                   transactional=True)
+    return True
+
+
+def archive_ended_conferences(today=None):
+    """Archive a batch of conferences whose endDate has passed; return
+    True if there may be more to do."""
+    today = today or date.today()
+    c_keys = Conference.query(Conference.endDate < today).fetch(
+        ARCHIVE_BATCH_SIZE, keys_only=True)
+    for c_key in c_keys:
+        if archive_conference(c_key):
+            # nobody can be promoted into an ended conference any more
+            wsck = c_key.urlsafe()
+            ndb.delete_multi(WaitlistEntry.query(
+                WaitlistEntry.websafeConferenceKey == wsck).fetch(
+                keys_only=True))
+    return len(c_keys) == ARCHIVE_BATCH_SIZE
+
+
+def prune_tombstones():
+    """Delete tombstones older than TOMBSTONE_RETENTION."""
+    cutoff = datetime.utcnow() - TOMBSTONE_RETENTION
+    ndb.delete_multi(Tombstone.query(Tombstone.deleted < cutoff).fetch(
+        keys_only=True))
+
+
+def run():
+    """Archive one batch and chain a task for the next, if any; used by
+    the archive cron job and task."""
+    if archive_ended_conferences():
+        taskqueue.add(url='/tasks/archive_conferences')
+    else:
+        prune_tombstones()
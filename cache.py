@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+"""cache.py
+
+Udacity conference server-side Python App Engine two tier cache;
+    in-instance LRU in front of memcache, with stale-while-revalidate
+    and a memcache lease so only one instance recomputes a value
+
+$Id$
+
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from google.appengine.api import memcache
+
+LEASE_SUFFIX = ':lease'
+
+
+class LocalLRU(object):
+    """LocalLRU -- small thread safe LRU kept in instance memory"""
+
+    def __init__(self, size=128):
+        self.size = size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return (value, fresh_until, local_until) for key, or None."""
+        with self._lock:
+            entry = self._items.pop(key, None)
+            if entry is not None:
+                # re-insert to mark as most recently used
+                self._items[key] = entry
+            return entry
+
+    def set(self, key, value, fresh_until, local_until):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (value, fresh_until, local_until)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+
+# shared by every SWRCache in this instance
+local_cache = LocalLRU()
+
+
+class SWRCache(object):
+    """SWRCache -- stale-while-revalidate cache for one memcache key.
+
+    Values are stored in memcache as (value, fresh_until) and kept for
+    fresh_for + stale_for seconds. Once a value goes stale, the first
+    caller to take the lease recomputes it while everybody else keeps
+    serving the stale copy. The local tier absorbs repeated reads in the
+    same instance for at most local_for seconds.
+    """
+
+    def __init__(self, key, compute, fresh_for=300, stale_for=3600,
+                 lease_for=30, local_for=5, default=None):
+        self.key = key
+        self.compute = compute
+        self.fresh_for = fresh_for
+        self.stale_for = stale_for
+        self.lease_for = lease_for
+        self.local_for = local_for
+        self.default = default
+
+    def get(self):
+        """Return the cached value, recomputing it if this caller holds
+        the lease."""
+        now = time.time()
+
+        # in-instance tier
+        entry = local_cache.get(self.key)
+        if entry and now < entry[2]:
+            return entry[0]
+
+        # memcache tier; anything that isn't a (value, fresh_until) pair
+        # was written by other code and counts as a miss
+        shared = memcache.get(self.key)
+        if not (isinstance(shared, tuple) and len(shared) == 2):
+            shared = None
+        if shared and now < shared[1]:
+            self._set_local(shared[0], shared[1])
+            return shared[0]
+
+        # stale or missing: one caller recomputes, the rest serve stale
+        stale = shared or entry
+        if self._acquire_lease():
+            try:
+                return self.refresh()
+            except Exception:
+                logging.exception('Failed to recompute %s', self.key)
+                if stale is None:
+                    raise
+            finally:
+                self._release_lease()
+
+        if stale is not None:
+            return stale[0]
+        return self.default
+
+    def refresh(self):
+        """Recompute the value unconditionally and store it in both tiers."""
+        value = self.compute()
+        self.set(value)
+        return value
+
+    def set(self, value):
+        """Store value in both tiers, fresh for fresh_for seconds."""
+        fresh_until = time.time() + self.fresh_for
+        memcache.set(self.key, (value, fresh_until),
+                     time=self.fresh_for + self.stale_for)
+        self._set_local(value, fresh_until)
+
+    def invalidate(self):
+        """Drop the value from both tiers."""
+        memcache.delete(self.key)
+        local_cache.delete(self.key)
+
+    def _set_local(self, value, fresh_until):
+        # local copies are only trusted for local_for seconds so that a
+        # refresh done by another instance is picked up quickly
+        local_until = min(fresh_until, time.time() + self.local_for)
+        local_cache.set(self.key, value, fresh_until, local_until)
+
+    def _acquire_lease(self):
+        # memcache.add() only succeeds if the key is not already there
+        return memcache.add(self.key + LEASE_SUFFIX, 1, time=self.lease_for)
+
+    def _release_lease(self):
+        memcache.delete(self.key + LEASE_SUFFIX)
@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+
+"""catalog.py
+
+Udacity conference server-side Python App Engine in-instance catalog;
+    columnar snapshot of Conference with bitmap indexes per city, topic
+    and month, used by queryConferences when CATALOG_SNAPSHOT is set
+
+The snapshot is loaded once per instance, mostly by the warmup request,
+in time-boxed steps that resume from a query cursor, and then refreshed
+from the Conference.updated change log. Until it is fully loaded,
+query() returns None and queryConferences uses Datastore.
+
+City, topic and month values index their rows with a posting: a set of
+rows while the value is rare, and a packed bitmap (one bit per row)
+once the set would take more memory than the bitmap. Free text cities
+are mostly rare, so they don't each cost a full bitmap. Filters are evaluated with numpy over
+packed bitmaps, so any mix of equality and inequality
+filters, on any number of fields, costs a few vector operations and no
+composite index.
+
+$Id$
+
+"""
+
+import operator
+import threading
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+from google.appengine.ext import ndb
+
+from archive import ARCHIVE_NAMESPACE
+from models import Conference
+from models import Profile
+
+REFRESH_SECONDS = 30
+# re-read changes this far behind the watermark, as the query on
+# Conference.updated is only eventually consistent
+REFRESH_OVERLAP = timedelta(seconds=10)
+LOAD_BATCH_SIZE = 1000
+# time the warmup request spends loading, within its deadline
+WARMUP_LOAD_SECONDS = 45
+# time a query spends loading when the instance started without a
+# warmup request, so a large catalog still gets loaded eventually
+QUERY_LOAD_SECONDS = 1
+
+OPERATORS = {
+    '=': operator.eq,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '<=': operator.le,
+    '!=': operator.ne,
+}
+
+# fields answered from per value postings; others from numeric columns
+BITMAP_FIELDS = ('city', 'topics', 'month')
+INT_FIELDS = ('month', 'maxAttendees')
+# rough memory a row takes in a set posting; a posting becomes a bitmap
+# once its set would be larger than the bitmap
+SPARSE_ROW_BYTES = 64
+# posting codes kept per row in a numpy column, to clear a row without
+# visiting every posting; rows with more topics keep the rest in a dict
+CODES_PER_ROW = 4
+
+
+class Interner(object):
+    """Interner -- maps repeated strings to small integer codes"""
+
+    def __init__(self):
+        self.codes = {}
+        self.values = []
+
+    def code(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+
+class CatalogSnapshot(object):
+    """CatalogSnapshot -- columnar copy of the Conference filter fields"""
+
+    def __init__(self, capacity=1024):
+        self._lock = threading.RLock()
+        self.size = 0
+        self.capacity = capacity
+        self.rows = {}
+        self.owners = Interner()
+        self.owner_col = np.zeros(capacity, np.int32)
+        self.id_col = np.zeros(capacity, np.int64)
+        self.max_attendees_col = np.zeros(capacity, np.int32)
+        self.live = self._empty()
+        # (field, value) -> code, field -> {value: code}, code -> posting
+        self.values = Interner()
+        self.field_codes = dict((field, {}) for field in BITMAP_FIELDS)
+        self.postings = {}
+        self.code_cols = np.full((capacity, CODES_PER_ROW), -1, np.int32)
+        self._extra_codes = {}
+        self.watermark = None
+        self.refreshed_at = 0
+        self.ready = False
+        self._load_cursor = None
+        self._load_started = None
+
+    # - - - bitmaps - - - - - - - - - - - - - - - - - - - - - - -
+
+    def _empty(self):
+        return np.zeros(self.capacity // 8, np.uint8)
+
+    @staticmethod
+    def _set_bit(bitmap, row):
+        # same bit order as np.packbits: most significant bit first
+        bitmap[row >> 3] |= 0x80 >> (row & 7)
+
+    @staticmethod
+    def _clear_bit(bitmap, row):
+        bitmap[row >> 3] &= ~(0x80 >> (row & 7)) & 0xff
+
+    def _grow(self):
+        grow = self.capacity
+        self.capacity *= 2
+        self.owner_col = np.concatenate(
+            [self.owner_col, np.zeros(grow, np.int32)])
+        self.id_col = np.concatenate([self.id_col, np.zeros(grow, np.int64)])
+        self.max_attendees_col = np.concatenate(
+            [self.max_attendees_col, np.zeros(grow, np.int32)])
+        self.code_cols = np.concatenate(
+            [self.code_cols, np.full((grow, CODES_PER_ROW), -1, np.int32)])
+        pad = np.zeros(grow // 8, np.uint8)
+        self.live = np.concatenate([self.live, pad])
+        for code, posting in self.postings.items():
+            if not isinstance(posting, set):
+                self.postings[code] = np.concatenate([posting, pad])
+
+    def _pack(self, rows):
+        """Return the packed bitmap of the rows."""
+        bits = np.zeros(self.capacity, np.bool_)
+        bits[list(rows)] = True
+        return np.packbits(bits)
+
+    # - - - postings - - - - - - - - - - - - - - - - - - - - - - -
+
+    def _code(self, field, value):
+        code = self.values.code((field, value))
+        self.field_codes[field][value] = code
+        return code
+
+    def _post(self, code, row):
+        posting = self.postings.get(code)
+        if posting is None:
+            posting = self.postings[code] = set()
+        if isinstance(posting, set):
+            posting.add(row)
+            if len(posting) * SPARSE_ROW_BYTES > self.capacity // 8:
+                self.postings[code] = self._pack(posting)
+        else:
+            self._set_bit(posting, row)
+
+    def _unpost(self, code, row):
+        posting = self.postings[code]
+        if isinstance(posting, set):
+            posting.discard(row)
+        else:
+            self._clear_bit(posting, row)
+
+    def _row_codes(self, row):
+        codes = [int(code) for code in self.code_cols[row] if code >= 0]
+        codes.extend(self._extra_codes.get(row, ()))
+        return codes
+
+    def _set_row_codes(self, row, codes):
+        self.code_cols[row] = -1
+        self.code_cols[row, :len(codes[:CODES_PER_ROW])] = \
+            codes[:CODES_PER_ROW]
+        if len(codes) > CODES_PER_ROW:
+            self._extra_codes[row] = codes[CODES_PER_ROW:]
+        else:
+            self._extra_codes.pop(row, None)
+
+    # - - - updates - - - - - - - - - - - - - - - - - - - - - - -
+
+    def upsert(self, conf):
+        """Add conf to the snapshot or replace its current row."""
+        key = conf.key
+        row_key = (key.parent().id(), key.id())
+        row = self.rows.get(row_key)
+        if row is None:
+            if self.size == self.capacity:
+                self._grow()
+            row = self.rows[row_key] = self.size
+            self.size += 1
+            self.owner_col[row] = self.owners.code(key.parent().id())
+            self.id_col[row] = key.id()
+        else:
+            self._clear_row(row)
+
+        self.max_attendees_col[row] = conf.maxAttendees or 0
+        field_values = {
+            'city': [conf.city] if conf.city else [],
+            'topics': set(conf.topics or []),
+            'month': [conf.month] if conf.month is not None else [],
+        }
+        codes = [self._code(field, value)
+                 for field, values in field_values.items()
+                 for value in values]
+        for code in codes:
+            self._post(code, row)
+        self._set_row_codes(row, codes)
+        self._set_bit(self.live, row)
+
+    def remove(self, key):
+        """Drop the Conference with this key from the snapshot."""
+        row = self.rows.pop((key.parent().id(), key.id()), None)
+        if row is not None:
+            self._clear_row(row)
+
+    def _clear_row(self, row):
+        self._clear_bit(self.live, row)
+        for code in self._row_codes(row):
+            self._unpost(code, row)
+        self._set_row_codes(row, [])
+
+    # - - - refresh - - - - - - - - - - - - - - - - - - - - - - -
+
+    def _track(self, conf):
+        self.upsert(conf)
+        updated = getattr(conf, 'updated', None)
+        if updated and (self.watermark is None or updated > self.watermark):
+            self.watermark = updated
+
+    def load_step(self, seconds):
+        """Load Conferences for about seconds, continuing where the last
+        step stopped; return True once the snapshot is ready. Returns
+        at once if another request is loading."""
+        if self.ready:
+            return True
+        if not self._lock.acquire(False):
+            return False
+        try:
+            deadline = time.time() + seconds
+            if self._load_started is None:
+                self._load_started = datetime.utcnow()
+            query = Conference.query().order(Conference.key)
+            more = True
+            while more and time.time() < deadline:
+                confs, cursor, more = query.fetch_page(
+                    LOAD_BATCH_SIZE, start_cursor=self._load_cursor)
+                for conf in confs:
+                    self.upsert(conf)
+                self._load_cursor = cursor
+            if not more:
+                # conferences changed while loading were read before the
+                # change, or not at all: replay the change log from the
+                # start of the load
+                self.watermark = self._load_started
+                self.refresh()
+                self.ready = True
+            return self.ready
+        finally:
+            self._lock.release()
+
+    def refresh(self):
+        """Apply conferences changed since the last refresh."""
+        with self._lock:
+            since = self.watermark - REFRESH_OVERLAP
+            changes = Conference.query(Conference.updated >= since).order(
+                Conference.updated)
+            for conf in changes.iter(batch_size=LOAD_BATCH_SIZE):
+                self._track(conf)
+            # archiving deletes the live entity; its archived copy is
+            # written with a fresh timestamp, so it shows up here
+            archived = Conference.query(
+                Conference.updated >= since,
+                namespace=ARCHIVE_NAMESPACE).iter(
+                batch_size=LOAD_BATCH_SIZE, keys_only=True)
+            for key in archived:
+                self.remove(key)
+            self.refreshed_at = time.time()
+
+    def ensure_fresh(self):
+        """Refresh a loaded snapshot if it is too old."""
+        if self.ready and time.time() - self.refreshed_at > REFRESH_SECONDS:
+            self.refresh()
+
+    # - - - queries - - - - - - - - - - - - - - - - - - - - - - -
+
+    def _match(self, field, op, value):
+        """Return the packed bitmap of rows where field op value holds."""
+        compare = OPERATORS[op]
+        if field in INT_FIELDS:
+            value = int(value)
+
+        if field in BITMAP_FIELDS:
+            # OR the postings of every distinct value that satisfies the
+            # filter; for the repeated topics this gives Datastore's
+            # "any value matches" semantics. Set postings are packed
+            # together, in one pass
+            result = self._empty()
+            sparse_rows = []
+            for candidate, code in self.field_codes[field].items():
+                if compare(candidate, value):
+                    posting = self.postings[code]
+                    if isinstance(posting, set):
+                        sparse_rows.extend(posting)
+                    else:
+                        np.bitwise_or(result, posting, result)
+            if sparse_rows:
+                np.bitwise_or(result, self._pack(sparse_rows), result)
+            return result
+
+        # numeric column: one vectorized comparison over every row
+        return np.packbits(compare(self.max_attendees_col, value))
+
+    def query(self, filters):
+        """Return keys of Conferences matching all filters, each a dict
+        with field, operator and value as built by _format_filters(), or
+        None while the snapshot is still loading."""
+        if not self.load_step(QUERY_LOAD_SECONDS):
+            return None
+        with self._lock:
+            self.ensure_fresh()
+            mask = self.live.copy()
+            for f in filters:
+                np.bitwise_and(mask,
+                               self._match(f['field'], f['operator'],
+                                           f['value']),
+                               mask)
+            rows = np.unpackbits(mask)[:self.size].nonzero()[0]
+            owners = self.owners.values
+            return [ndb.Key(Profile, owners[self.owner_col[row]],
+                            Conference, int(self.id_col[row]))
+                    for row in rows]
+
+
+# one snapshot per instance
+snapshot = CatalogSnapshot()
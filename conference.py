@@ -11,41 +11,110 @@ created by wesc on 2014 apr 21
 """
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
-from datetime import datetime, time
+import base64
+import hashlib
+import json
+import zlib
+from collections import Counter
+from datetime import datetime, time, timedelta
+import time as pytime
 
 import endpoints
 from protorpc import messages
 from protorpc import message_types
+from protorpc import protojson
 from protorpc import remote
 
-from google.appengine.api import memcache
 from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
 
+import archive
+import facets
+from cache import SWRCache
+from instrumentation import incr
+from instrumentation import instrumented
+from ratelimit import admit_registration
+from ratelimit import throttled
+
+from models import ChangeForm
+from models import ChangesForm
 from models import ConflictException
 from models import Profile
+from models import put_multi_if_changed
 from models import ProfileMiniForm
 from models import ProfileForm
 from models import BooleanMessage
 from models import Conference
 from models import ConferenceForm
 from models import ConferenceForms
+from models import ConferenceDetailForm
+from models import ConferenceResultForm
+from models import ConferenceResultForms
+from models import ConferenceFacetsForm
+from models import FacetCountForm
 from models import ConferenceQueryForm
 from models import ConferenceQueryForms
 from models import TeeShirtSize
 from models import StringMessage
 from models import Session
+from models import FeaturedSpeaker
+from models import Tombstone
+from models import WaitlistEntry
 from models import SessionForm
 from models import SessionForms
+from models import SessionRecommendations
+from models import SessionResultForm
+from models import SessionResultForms
+from models import WebsafeKeysForm
 
 from utils import get_user_id
 
 from settings import WEB_CLIENT_ID
+from settings import CATALOG_SNAPSHOT
 
 EMAIL_SCOPE = endpoints.EMAIL_SCOPE
 API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
-MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
-MEMCACHE_FEATURED_SPEAKER_KEY = "FEATURED_SPEAKER"
+# renamed when SWRCache started storing (value, fresh_until) pairs, as
+# plain strings may still sit under the old keys
+MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS_V2"
+MEMCACHE_FEATURED_SPEAKER_KEY = "FEATURED_SPEAKER_V2"
+MEMCACHE_PUBLIC_CONFERENCES_KEY = "PUBLIC_CONFERENCES_V3"
+FEATURED_SPEAKER_ID = "featured"
+WAITLIST_PROMOTE_BATCH = 10
+CHANGES_PAGE_SIZE = 100
+CHANGES_MAX_PAGE_SIZE = 500
+# hand back a watermark this far behind the end of the scan, as queries
+# on updated are eventually consistent; clients may see a change twice
+CHANGES_OVERLAP = timedelta(seconds=10)
+WATERMARK_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+# (model, timestamp property) scanned in turn by getChangesSince
+CHANGE_SOURCES = [
+    (Conference, 'updated'),
+    (Session, 'updated'),
+    (Tombstone, 'deleted'),
+]
+# the rendered listing must fit in one memcache value; past it, the
+# listing carries a websafeCursor to continue with queryConferences
+PUBLIC_LISTING_LIMIT = 1000
+# re-render the public listing at most once per this many seconds
+PUBLIC_RENDER_INTERVAL = 10
+# ConferenceForm fields the public listing shows; organizerUserId is
+# the organizer's email address
+PUBLIC_FIELDS = frozenset(field.name for field in ConferenceForm.all_fields()
+                          if field.name != 'organizerUserId')
+# most keys getConferencesByKeys / getSessionsByKeys accept per call
+BATCH_GET_LIMIT = 100
+# most sessions createSessions accepts per call; keeps the speaker list
+# (up to 1500 bytes a name, as speaker is indexed) inside the 100 KB
+# task size limit of set_featured_speaker
+CREATE_SESSIONS_LIMIT = 50
+# long queries return what they have, plus a cursor, after this many
+# seconds; well inside the 60 second request deadline, leaving time to
+# look up organizers and serialize the response
+QUERY_BUDGET_SECONDS = 30
+QUERY_BATCH_SIZE = 200
+# queryConferences also returns a cursor after about this many results
+QUERY_PAGE_LIMIT = 1000
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
@@ -82,31 +151,55 @@ CONF_POST_REQUEST = endpoints.ResourceContainer(
     websafeConferenceKey=messages.StringField(1),
 )
 
+LIST_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    fieldMask=messages.StringField(1),
+    compressed=messages.BooleanField(2),
+)
+
 SESSION_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeConferenceKey=messages.StringField(1),
+    fieldMask=messages.StringField(2),
+    compressed=messages.BooleanField(3),
 )
 
 SESSION_GET_BY_TYPE_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeConferenceKey=messages.StringField(1),
-    typeOfSession=messages.StringField(2)
+    typeOfSession=messages.StringField(2),
+    fieldMask=messages.StringField(3),
+    compressed=messages.BooleanField(4),
 )
 
 SESSION_GET_BY_SPEAKER_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
-    speaker=messages.StringField(1)
+    speaker=messages.StringField(1),
+    fieldMask=messages.StringField(2),
+    compressed=messages.BooleanField(3),
+    websafeCursor=messages.StringField(4),
+)
+
+SESSION_PAGE_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    fieldMask=messages.StringField(1),
+    compressed=messages.BooleanField(2),
+    websafeCursor=messages.StringField(3),
 )
 
 SESSION_GET_BY_DATE_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
-    date=messages.StringField(1)
+    date=messages.StringField(1),
+    fieldMask=messages.StringField(2),
+    compressed=messages.BooleanField(3),
 )
 
 SESSION_GET_BY_NOT_TYPE_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeConferenceKey=messages.StringField(1),
-    excludedTypeOfSession=messages.StringField(2)
+    excludedTypeOfSession=messages.StringField(2),
+    fieldMask=messages.StringField(3),
+    compressed=messages.BooleanField(4),
 )
 
 SESSION_POST_REQUEST = endpoints.ResourceContainer(
@@ -114,11 +207,28 @@ SESSION_POST_REQUEST = endpoints.ResourceContainer(
     websafeConferenceKey=messages.StringField(1)
 )
 
+SESSIONS_POST_REQUEST = endpoints.ResourceContainer(
+    SessionForms,
+    websafeConferenceKey=messages.StringField(1)
+)
+
+CHANGES_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    since=messages.StringField(1),
+    websafeCursor=messages.StringField(2),
+    limit=messages.IntegerField(3, variant=messages.Variant.INT32),
+)
+
 WISHLIST_POST_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeSessionKey=messages.StringField(1)
 )
 
+SESSION_RECOMMENDED_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeSessionKey=messages.StringField(1)
+)
+
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
@@ -129,12 +239,99 @@ WISHLIST_POST_REQUEST = endpoints.ResourceContainer(
 class ConferenceApi(remote.Service):
     """Conference API v0.1"""
 
+    # - - - List responses - - - - - - - - - - - - - - - - - - -
+
+    def _field_mask(self, request, form_class):
+        """Return the set of form fields named in request.fieldMask, or
+        None to copy every field."""
+        if not request.fieldMask:
+            return None
+        fields = set(name.strip() for name in request.fieldMask.split(',')
+                     if name.strip())
+        unknown = fields - set(field.name for field in form_class.all_fields())
+        if unknown:
+            raise endpoints.BadRequestException(
+                'Unknown fields in fieldMask: %s' % ', '.join(sorted(unknown)))
+        return fields
+
+    def _list_response(self, forms, request, method_name):
+        """Return forms as is, or with items replaced by gzipped JSON in
+        compressedItems if the request asked for it."""
+        if not request.compressed:
+            return forms
+        payload = protojson.encode_message(forms)
+        gzip = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED,
+                                16 + zlib.MAX_WBITS)
+        compressed = gzip.compress(payload) + gzip.flush()
+        incr('%s.bytes.json' % method_name, len(payload))
+        # BytesFields travel base64 encoded: count what is actually sent
+        incr('%s.bytes.gzip' % method_name, (len(compressed) + 2) // 3 * 4)
+        return forms.__class__(compressedItems=compressed,
+                               websafeCursor=forms.websafeCursor)
+
+    def _conference_list(self, conferences, names, request, method_name,
+                         cursor=None):
+        """Return ConferenceForms for conferences, names mapping organizer
+        user IDs to display names."""
+        fields = self._field_mask(request, ConferenceForm)
+        return self._list_response(ConferenceForms(
+            items=[self._copy_conference_to_form(
+                conf, names.get(conf.organizerUserId), fields)
+                for conf in conferences],
+            websafeCursor=cursor,
+        ), request, method_name)
+
+    def _session_list(self, sessions, request, method_name, cursor=None):
+        """Return SessionForms for sessions."""
+        fields = self._field_mask(request, SessionForm)
+        return self._list_response(SessionForms(
+            items=[self._copy_session_to_form(session, fields)
+                   for session in sessions],
+            websafeCursor=cursor,
+        ), request, method_name)
+
+    def _fetch_within_budget(self, query, request, method_name,
+                             keep=None, limit=None):
+        """Run query in batches, resuming at request.websafeCursor, until
+        it is exhausted, the next batch could overrun the query budget or,
+        if given, limit results were found. Return the results (those
+        keep() accepts, if given) and a websafe cursor to continue from,
+        or None once everything was read."""
+        started = pytime.time()
+        cursor = None
+        if request.websafeCursor:
+            try:
+                cursor = ndb.Cursor(urlsafe=request.websafeCursor)
+            except Exception:
+                raise endpoints.BadRequestException(
+                    'Invalid websafeCursor: %s' % request.websafeCursor)
+
+        results = []
+        slowest = 0
+        more = True
+        while more:
+            batch_started = pytime.time()
+            batch, cursor, more = query.fetch_page(QUERY_BATCH_SIZE,
+                                                   start_cursor=cursor)
+            results.extend(batch if keep is None else filter(keep, batch))
+            now = pytime.time()
+            slowest = max(slowest, now - batch_started)
+            if more and now + slowest > started + QUERY_BUDGET_SECONDS:
+                incr('%s.partial' % method_name)
+                return results, cursor.urlsafe()
+            if more and limit and len(results) >= limit:
+                return results, cursor.urlsafe()
+        return results, None
+
     # - - - Conference objects - - - - - - - - - - - - - - - - -
 
-    def _copy_conference_to_form(self, conf, display_name):
-        """Copy relevant fields from Conference to ConferenceForm."""
+    def _copy_conference_to_form(self, conf, display_name, fields=None):
+        """Copy relevant fields from Conference to ConferenceForm, only
+        those in fields if given."""
         cf = ConferenceForm()
         for field in cf.all_fields():
+            if fields is not None and field.name not in fields:
+                continue
             if hasattr(conf, field.name):
                 # convert Date to date string; just copy others
                 if field.name.endswith('Date'):
@@ -143,7 +340,8 @@ class ConferenceApi(remote.Service):
                     setattr(cf, field.name, getattr(conf, field.name))
             elif field.name == "websafeKey":
                 setattr(cf, field.name, conf.key.urlsafe())
-        if display_name:
+        if display_name and (fields is None or
+                             'organizerDisplayName' in fields):
             setattr(cf, 'organizerDisplayName', display_name)
         cf.check_initialized()
         return cf
@@ -186,6 +384,7 @@ class ConferenceApi(remote.Service):
         # set seatsAvailable to be same as maxAttendees on creation
         if data["maxAttendees"] > 0:
             data["seatsAvailable"] = data["maxAttendees"]
+        data['facetsCounted'] = True
         # generate Profile Key based on user ID and Conference
         # ID based on Profile key get Conference key from ID
         p_key = ndb.Key(Profile, user_id)
@@ -196,10 +395,13 @@ class ConferenceApi(remote.Service):
 
         # create Conference, send email to organizer confirming
         # creation of Conference & return (modified) ConferenceForm
-        Conference(**data).put()
+        conf = Conference(**data)
+        conf.put()
         taskqueue.add(
             params={'email': user.email(), 'conferenceInfo': repr(request)},
             url='/tasks/send_confirmation_email')
+        facets.enqueue(facets.deltas_for(conf, 'conferences', 1))
+        self._schedule_public_render()
 
         return request
 
@@ -226,6 +428,23 @@ class ConferenceApi(remote.Service):
             raise endpoints.ForbiddenException(
                 'Only the owner can update the conference.')
 
+        # take the conference (and its registrations) out of its current
+        # facets; merged with the new facets below, so unchanged ones cancel
+        registered = facets.registered(conf)
+        deltas = (facets.deltas_for(conf, 'conferences', -1) +
+                  facets.deltas_for(conf, 'registrations', -registered))
+
+        # seats only change through registrations: a new maxAttendees
+        # moves seatsAvailable along with it, so the number registered
+        # (maxAttendees - seatsAvailable) stays the same
+        request.seatsAvailable = None
+        if request.maxAttendees is not None:
+            if request.maxAttendees < registered:
+                raise endpoints.BadRequestException(
+                    'maxAttendees can not be below the %d registered '
+                    'attendees.' % registered)
+            conf.seatsAvailable = request.maxAttendees - registered
+
         # Not getting all the fields, so don't create a new object; just
         # copy relevant fields from ConferenceForm to Conference object
         for field in request.all_fields():
@@ -239,12 +458,17 @@ class ConferenceApi(remote.Service):
                         conf.month = data.month
                 # write to Conference object
                 setattr(conf, field.name, data)
-        conf.put()
+        conf.put_if_changed()
+        deltas += (facets.deltas_for(conf, 'conferences', 1) +
+                   facets.deltas_for(conf, 'registrations', registered))
+        facets.enqueue(deltas, transactional=True)
         prof = ndb.Key(Profile, user_id).get()
         return self._copy_conference_to_form(conf, getattr(prof, 'displayName'))
 
     @endpoints.method(ConferenceForm, ConferenceForm, path='conference',
                       http_method='POST', name='createConference')
+    @instrumented('createConference')
+    @throttled
     def create_conference(self, request):
         """Create new conference."""
         return self._create_conference_object(request)
@@ -253,28 +477,143 @@ class ConferenceApi(remote.Service):
                       path='conference/{websafeConferenceKey}',
                       http_method='PUT',
                       name='updateConference')
+    @instrumented('updateConference')
+    @throttled
     def update_conference(self, request):
         """Update conference w/provided fields & return w/updated info."""
-        return self._update_conference_object(request)
+        form = self._update_conference_object(request)
+        self._schedule_public_render()
+        return form
 
     @endpoints.method(CONF_GET_REQUEST, ConferenceForm,
                       path='conference/{websafeConferenceKey}',
                       http_method='GET',
                       name='getConference')
+    @instrumented('getConference')
+    @throttled
     def get_conference(self, request):
         """Return requested conference (by websafeConferenceKey)."""
         # get Conference object from request; bail if not found
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        conf = archive.get(ndb.Key(urlsafe=request.websafeConferenceKey))
         if not conf:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % request.websafeConferenceKey)
-        prof = conf.key.parent().get()
+        prof = ndb.Key(Profile, conf.organizerUserId).get()
         # return ConferenceForm
         return self._copy_conference_to_form(conf, getattr(prof, 'displayName'))
 
-    @endpoints.method(message_types.VoidMessage, ConferenceForms,
+    @endpoints.method(CONF_GET_REQUEST, ConferenceDetailForm,
+                      path='conference/{websafeConferenceKey}/detail',
+                      http_method='GET',
+                      name='getConferenceDetail')
+    @instrumented('getConferenceDetail')
+    @throttled
+    def get_conference_detail(self, request):
+        """Return conference, its sessions and the caller's registration
+        and wishlist status in one response."""
+        c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        # the organizer is looked up from the key's Profile parent
+        if c_key.kind() != "Conference" or c_key.parent() is None:
+            raise endpoints.BadRequestException(
+                "websafeConferenceKey must reference a Conference")
+
+        # start all independent fetches before waiting on any of them
+        conf_future = c_key.get_async()
+        organizer_future = ndb.Key(Profile, c_key.parent().id()).get_async()
+        sessions_future = Session.query(ancestor=c_key).fetch_async()
+        prof_future = None
+        user = endpoints.get_current_user()
+        if user:
+            prof_future = ndb.Key(Profile, get_user_id(user)).get_async()
+
+        conf = conf_future.get_result()
+        if not conf and not archive.is_archived(c_key):
+            conf = archive.get(c_key)
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % request.websafeConferenceKey)
+        organizer = organizer_future.get_result()
+        if archive.is_archived(conf.key):
+            sessions = archive.get_sessions(conf.key)
+        else:
+            sessions = sessions_future.get_result()
+        prof = prof_future.get_result() if prof_future else None
+
+        detail = ConferenceDetailForm(
+            conference=self._copy_conference_to_form(
+                conf, getattr(organizer, 'displayName', None)),
+            sessions=[self._copy_session_to_form(session)
+                      for session in sessions],
+            isUserAttending=False,
+        )
+        if prof:
+            detail.isUserAttending = \
+                request.websafeConferenceKey in prof.conferenceKeysToAttend
+            # only report wishlisted sessions that belong to this conference
+            session_keys = set(sf.websafeSessionKey for sf in detail.sessions)
+            detail.sessionKeysWishList = [
+                wssk for wssk in prof.sessionKeysWishList
+                if wssk in session_keys]
+        return detail
+
+    def _decode_websafe_keys(self, websafe_keys, kind):
+        """Return a (key, error) pair per websafe key; key is None if the
+        websafe key is malformed or of another kind."""
+        if len(websafe_keys) > BATCH_GET_LIMIT:
+            raise endpoints.BadRequestException(
+                'At most %d keys can be looked up at once' % BATCH_GET_LIMIT)
+        decoded = []
+        for wsk in websafe_keys:
+            try:
+                key = ndb.Key(urlsafe=wsk)
+            except Exception:
+                # malformed keys raise several unrelated exception types
+                decoded.append((None, 'Invalid key'))
+                continue
+            if key.kind() != kind:
+                decoded.append((None, 'Not a %s key' % kind))
+            else:
+                decoded.append((key, None))
+        return decoded
+
+    @endpoints.method(WebsafeKeysForm, ConferenceResultForms,
+                      path='getConferencesByKeys', http_method='POST',
+                      name='getConferencesByKeys')
+    @instrumented('getConferencesByKeys')
+    @throttled
+    def get_conferences_by_keys(self, request):
+        """Return conferences by websafeConferenceKey, in request order,
+        marking keys that are invalid or not found instead of failing."""
+        decoded = self._decode_websafe_keys(request.websafeKeys,
+                                            'Conference')
+        keys = list(set(key for key, _ in decoded if key))
+        # falls back to the archive for conferences that have ended
+        conferences = dict(zip(keys, archive.get_multi(keys)))
+
+        organisers = list(set(ndb.Key(Profile, conf.organizerUserId)
+                              for conf in conferences.values() if conf))
+        names = dict((prof.key.id(), prof.displayName)
+                     for prof in ndb.get_multi(organisers) if prof)
+
+        items = []
+        for wsk, (key, error) in zip(request.websafeKeys, decoded):
+            result = ConferenceResultForm(websafeKey=wsk)
+            conf = conferences.get(key) if key else None
+            if error:
+                result.error = error
+            elif not conf:
+                result.notFound = True
+            else:
+                result.conference = self._copy_conference_to_form(
+                    conf, names.get(conf.organizerUserId))
+            items.append(result)
+        return ConferenceResultForms(items=items)
+
+    @endpoints.method(LIST_GET_REQUEST, ConferenceForms,
                       path='getConferencesCreated', http_method='POST',
                       name='getConferencesCreated')
+    @instrumented('getConferencesCreated')
+    @throttled
     def get_conferences_created(self, request):
         """Return conferences created by user."""
         # make sure user is authed
@@ -286,15 +625,17 @@ class ConferenceApi(remote.Service):
         confs = Conference.query(ancestor=ndb.Key(Profile, user_id))
         prof = ndb.Key(Profile, user_id).get()
         # return set of ConferenceForm objects per Conference
-        return ConferenceForms(
-            items=[self._copy_conference_to_form(conf,
-                                                 getattr(prof, 'displayName'))
-                   for conf in confs]
-        )
+        return self._conference_list(
+            confs, {user_id: getattr(prof, 'displayName')}, request,
+            'getConferencesCreated')
 
     def _get_query(self, request):
         """Return formatted query from the submitted filters."""
-        q = Conference.query()
+        # the archive holds the same kind, so the same indexes serve it
+        if request.archived:
+            q = Conference.query(namespace=archive.ARCHIVE_NAMESPACE)
+        else:
+            q = Conference.query()
         inequality_filter, filters = self._format_filters(request.filters)
 
         # If exists, sort on inequality filter first
@@ -313,7 +654,29 @@ class ConferenceApi(remote.Service):
             q = q.filter(formatted_query)
         return q
 
-    def _format_filters(self, filters):
+    def _get_snapshot_query(self, request):
+        """Return conferences matching the submitted filters, evaluated
+        against the in-instance catalog snapshot, or None if it isn't
+        loaded yet."""
+        # imported here so numpy is only loaded when the snapshot is on
+        import catalog
+
+        inequality_field, filters = self._format_filters(
+            request.filters, multiple_inequalities=True)
+        keys = catalog.snapshot.query(filters)
+        if keys is None:
+            return None
+        conferences = [conf for conf in ndb.get_multi(keys) if conf]
+
+        # same order as the Datastore query: inequality field, then name
+        if inequality_field:
+            conferences.sort(key=lambda conf: (
+                getattr(conf, inequality_field), conf.name))
+        else:
+            conferences.sort(key=lambda conf: conf.name)
+        return conferences
+
+    def _format_filters(self, filters, multiple_inequalities=False):
         """Parse, check validity and format user supplied filters."""
         formatted_filters = []
         inequality_field = None
@@ -334,7 +697,8 @@ class ConferenceApi(remote.Service):
                 # check if inequality operation has been used in previous filters
                 # disallow the filter if inequality was performed on a different field before
                 # track the field on which the inequality operation is performed
-                if inequality_field and inequality_field != filtr["field"]:
+                if (inequality_field and inequality_field != filtr["field"]
+                        and not multiple_inequalities):
                     raise endpoints.BadRequestException(
                         "Inequality filter is allowed on only one field.")
                 else:
@@ -346,9 +710,27 @@ class ConferenceApi(remote.Service):
     @endpoints.method(ConferenceQueryForms, ConferenceForms,
                       path='queryConferences', http_method='POST',
                       name='queryConferences')
+    @instrumented('queryConferences')
+    @throttled
     def query_conferences(self, request):
-        """Query for conferences."""
-        conferences = self._get_query(request)
+        """Query for conferences. If the query runs long, return the
+        conferences found so far and a websafeCursor; send the same
+        filters with that cursor to continue."""
+        conferences, cursor = None, None
+        # the snapshot only holds live conferences; until it is loaded,
+        # Datastore answers. A cursor came from a Datastore query, which
+        # only Datastore can resume
+        if (CATALOG_SNAPSHOT and not request.archived and
+                not request.websafeCursor):
+            conferences = self._get_snapshot_query(request)
+        if conferences is None:
+            if any(f.operator == 'NE' for f in request.filters):
+                # ndb runs != as a multi-query, which cursors can't resume
+                conferences = self._get_query(request).fetch()
+            else:
+                conferences, cursor = self._fetch_within_budget(
+                    self._get_query(request), request, 'queryConferences',
+                    limit=QUERY_PAGE_LIMIT)
 
         # need to fetch organiser displayName from profiles
         # get all keys and use get_multi for speed
@@ -362,12 +744,151 @@ class ConferenceApi(remote.Service):
             names[profile.key.id()] = profile.displayName
 
         # return individual ConferenceForm object per Conference
-        return ConferenceForms(
-            items=[
-                self._copy_conference_to_form(conf, names[conf.organizerUserId])
-                for conf in conferences]
+        return self._conference_list(conferences, names, request,
+                                     'queryConferences', cursor)
+
+    @endpoints.method(message_types.VoidMessage, ConferenceFacetsForm,
+                      path='conferences/facets', http_method='GET',
+                      name='getConferenceFacets')
+    @instrumented('getConferenceFacets')
+    @throttled
+    def get_conference_facets(self, request):
+        """Return conference and registration counts per city, topic and
+        month, from the sharded facet counters."""
+        counts = facets.get_counts()
+
+        by_value = {}
+        for (metric, dimension, value), count in counts.items():
+            by_value.setdefault((dimension, value), {})[metric] = count
+
+        forms = {}
+        for (dimension, value), metrics in by_value.items():
+            forms.setdefault(dimension, []).append(FacetCountForm(
+                value=value,
+                conferences=metrics.get('conferences', 0),
+                registrations=metrics.get('registrations', 0)))
+        for items in forms.values():
+            items.sort(key=lambda f: (-f.conferences, f.value))
+
+        total = by_value.get((facets.TOTAL, ''), {})
+        return ConferenceFacetsForm(
+            cities=forms.get('city', []),
+            topics=forms.get('topic', []),
+            months=forms.get('month', []),
+            totalConferences=total.get('conferences', 0),
+            totalRegistrations=total.get('registrations', 0),
         )
 
+    # - - - Changes feed - - - - - - - - - - - - - - - - - - - -
+
+    @staticmethod
+    def _parse_watermark(value):
+        try:
+            return datetime.strptime(value, WATERMARK_FORMAT)
+        except ValueError:
+            try:
+                return datetime.strptime(value, WATERMARK_FORMAT[:-3])
+            except ValueError:
+                raise endpoints.BadRequestException(
+                    'Invalid watermark: %s' % value)
+
+    @staticmethod
+    def _encode_changes_cursor(phase, until, cursor):
+        token = {'phase': phase, 'until': until.strftime(WATERMARK_FORMAT),
+                 'cursor': cursor.urlsafe() if cursor else None}
+        return base64.urlsafe_b64encode(json.dumps(token))
+
+    def _decode_changes_cursor(self, websafe_cursor):
+        try:
+            token = json.loads(base64.urlsafe_b64decode(str(websafe_cursor)))
+            phase, until = token['phase'], token['until']
+            cursor = token['cursor'] and ndb.Cursor(urlsafe=token['cursor'])
+        except Exception:
+            # malformed query cursors raise several unrelated exception
+            # types
+            raise endpoints.BadRequestException(
+                'Invalid websafeCursor: %s' % websafe_cursor)
+        # a phase past the sources would skip the scan and advance the
+        # watermark over changes never returned
+        if not isinstance(phase, int) or not 0 <= phase < len(CHANGE_SOURCES):
+            raise endpoints.BadRequestException(
+                'Invalid websafeCursor: %s' % websafe_cursor)
+        return phase, self._parse_watermark(until), cursor
+
+    @endpoints.method(CHANGES_GET_REQUEST, ChangesForm,
+                      path='changes', http_method='GET',
+                      name='getChangesSince')
+    @instrumented('getChangesSince')
+    @throttled
+    def get_changes_since(self, request):
+        """Return keys of conferences and sessions changed or deleted,
+        and the caller's profile if changed, after the since watermark.
+        Page with websafeCursor; once a response has no cursor, pass
+        its watermark as since on the next sync. Entities written before
+        they had an updated stamp are only found once the stamp_*
+        mappers have run."""
+        if request.since:
+            since = self._parse_watermark(request.since)
+        else:
+            since = datetime(1970, 1, 1)
+        limit = max(1, min(request.limit or CHANGES_PAGE_SIZE,
+                           CHANGES_MAX_PAGE_SIZE))
+        if request.websafeCursor:
+            phase, until, cursor = self._decode_changes_cursor(
+                request.websafeCursor)
+        else:
+            phase, until, cursor = 0, datetime.utcnow(), None
+
+        changes = ChangesForm(
+            watermark=(until - CHANGES_OVERLAP).strftime(WATERMARK_FORMAT))
+        if request.since and since < until - archive.TOMBSTONE_RETENTION:
+            # deletions that old have been forgotten
+            changes.fullResync = True
+            return changes
+
+        # only the first page reports the caller's own profile
+        user = endpoints.get_current_user()
+        if user and phase == 0 and not cursor:
+            prof = ndb.Key(Profile, get_user_id(user)).get()
+            if prof and prof.updated and since < prof.updated <= until:
+                changes.changed.append(ChangeForm(
+                    kind='Profile', websafeKey=prof.key.urlsafe(),
+                    updated=prof.updated.strftime(WATERMARK_FORMAT)))
+
+        # scan each source in turn; the cursor remembers where we stopped
+        sources = CHANGE_SOURCES
+        while phase < len(sources):
+            model, stamp_name = sources[phase]
+            prop = getattr(model, stamp_name)
+            query = model.query(prop > since, prop <= until).order(prop)
+            entities, cursor, more = query.fetch_page(
+                limit, start_cursor=cursor)
+            for entity in entities:
+                stamp = getattr(entity, stamp_name).strftime(
+                    WATERMARK_FORMAT)
+                if model is Tombstone:
+                    changes.deleted.extend(
+                        ChangeForm(kind=ndb.Key(urlsafe=wsk).kind(),
+                                   websafeKey=wsk, updated=stamp)
+                        for wsk in entity.websafeKeys)
+                else:
+                    changes.changed.append(ChangeForm(
+                        kind=model.__name__, websafeKey=entity.key.urlsafe(),
+                        updated=stamp))
+            limit -= len(entities)
+            if more:
+                if limit <= 0:
+                    changes.websafeCursor = self._encode_changes_cursor(
+                        phase, until, cursor)
+                    return changes
+                continue
+            phase, cursor = phase + 1, None
+            if limit <= 0 and phase < len(sources):
+                changes.websafeCursor = self._encode_changes_cursor(
+                    phase, until, None)
+                return changes
+        return changes
+
     # - - - Profile objects - - - - - - - - - - - - - - - - - - -
 
     def _copy_profile_to_form(self, prof):
@@ -424,19 +945,23 @@ class ConferenceApi(remote.Service):
                             setattr(prof, field, str(val).upper())
                         else:
                             setattr(prof, field, val)
-            prof.put()
+            prof.put_if_changed()
 
         # return ProfileForm
         return self._copy_profile_to_form(prof)
 
     @endpoints.method(message_types.VoidMessage, ProfileForm, path='profile',
                       http_method='GET', name='getProfile')
+    @instrumented('getProfile')
+    @throttled
     def get_profile(self, request):
         """Return user profile."""
         return self._do_profile()
 
     @endpoints.method(ProfileMiniForm, ProfileForm, path='profile',
                       http_method='POST', name='saveProfile')
+    @instrumented('saveProfile')
+    @throttled
     def save_profile(self, request):
         """Update & return user profile."""
         return self._do_profile(request)
@@ -444,8 +969,10 @@ class ConferenceApi(remote.Service):
     # - - - Registration - - - - - - - - - - - - - - - - - - - -
 
     @ndb.transactional(xg=True)
-    def _conference_registration(self, request, reg=True):
-        """Register or unregister user for selected conference."""
+    def _conference_registration(self, request, reg=True, waitlist_head=None):
+        """Register or unregister user for selected conference. When
+        unregistering, the freed seat goes straight to the WaitlistEntry
+        waitlist_head, if given and still waiting."""
         retval = None
         prof = self._get_profile_from_user()  # get user Profile
 
@@ -472,6 +999,8 @@ class ConferenceApi(remote.Service):
             # register user, take away one seat
             prof.conferenceKeysToAttend.append(wsck)
             conf.seatsAvailable -= 1
+            facets.enqueue(facets.deltas_for(conf, 'registrations', 1),
+                           transactional=True)
             retval = True
 
         # unregister
@@ -479,27 +1008,44 @@ class ConferenceApi(remote.Service):
             # check if user already registered
             if wsck in prof.conferenceKeysToAttend:
 
-                # unregister user, add back one seat
+                # unregister user and add back one seat
                 prof.conferenceKeysToAttend.remove(wsck)
                 conf.seatsAvailable += 1
+                facets.enqueue(facets.deltas_for(conf, 'registrations', -1),
+                               transactional=True)
+                # the seat is never free for others to grab while users
+                # wait: give it to the head of the waitlist in this
+                # transaction, or have the task look further down the queue
+                entry = waitlist_head and waitlist_head.get()
+                if entry and entry.userId == prof.key.id():
+                    # registered since joining; leaving, not waiting
+                    entry.key.delete()
+                    entry = None
+                if not (entry and self._take_seat(entry, conf)):
+                    taskqueue.add(params={'websafeConferenceKey': wsck},
+                                  url='/tasks/promote_waitlist',
+                                  transactional=True)
                 retval = True
             else:
                 retval = False
 
-        # write things back to the datastore & return
-        prof.put()
-        conf.put()
+        # write things back to the datastore & return; unregistering
+        # when not registered changes nothing
+        put_multi_if_changed([prof, conf])
         return BooleanMessage(data=retval)
 
-    @endpoints.method(message_types.VoidMessage, ConferenceForms,
+    @endpoints.method(LIST_GET_REQUEST, ConferenceForms,
                       path='conferences/attending', http_method='GET',
                       name='getConferencesToAttend')
+    @instrumented('getConferencesToAttend')
+    @throttled
     def get_conferences_to_attend(self, request):
         """Get list of conferences that user has registered for."""
         prof = self._get_profile_from_user()  # get user Profile
         conf_keys = [ndb.Key(urlsafe=wsck) for wsck in
                      prof.conferenceKeysToAttend]
-        conferences = ndb.get_multi(conf_keys)
+        # conferences attended in the past have moved to the archive
+        conferences = [conf for conf in archive.get_multi(conf_keys) if conf]
 
         # get organizers
         organisers = [ndb.Key(Profile, conf.organizerUserId) for conf in
@@ -512,113 +1058,342 @@ class ConferenceApi(remote.Service):
             names[profile.key.id()] = profile.displayName
 
         # return set of ConferenceForm objects per Conference
-        return ConferenceForms(
-            items=[
-                self._copy_conference_to_form(conf, names[conf.organizerUserId])
-                for conf in conferences]
-        )
+        return self._conference_list(conferences, names, request,
+                                     'getConferencesToAttend')
 
     @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
                       path='conference/{websafeConferenceKey}',
                       http_method='POST',
                       name='registerForConference')
+    @instrumented('registerForConference')
+    @throttled
     def register_for_conference(self, request):
         """Register user for selected conference."""
-        return self._conference_registration(request)
+        admit_registration(request.websafeConferenceKey)
+        # turn sold out requests away before starting a transaction on
+        # the (hot) conference entity group
+        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        if conf and conf.seatsAvailable <= 0:
+            raise ConflictException(
+                "There are no seats available. Join the waitlist to be "
+                "registered when a seat frees up.")
+        result = self._conference_registration(request)
+        self._schedule_public_render()
+        return result
 
     @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
                       path='conference/{websafeConferenceKey}',
                       http_method='DELETE',
                       name='unregisterFromConference')
+    @instrumented('unregisterFromConference')
+    @throttled
     def unregister_from_conference(self, request):
         """Unregister user for selected conference."""
-        return self._conference_registration(request, reg=False)
+        admit_registration(request.websafeConferenceKey)
+        wsck = request.websafeConferenceKey
+        # queries can't run in the (non-ancestor) transaction; the entry
+        # is read again inside it
+        head = WaitlistEntry.query(
+            WaitlistEntry.websafeConferenceKey == wsck).order(
+            WaitlistEntry.joined).get(keys_only=True)
+        result = self._conference_registration(request, reg=False,
+                                               waitlist_head=head)
+        self._schedule_public_render()
+        return result
+
+    # - - - Waitlist - - - - - - - - - - - - - - - - - - - - - -
+
+    @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
+                      path='conference/{websafeConferenceKey}/waitlist',
+                      http_method='POST',
+                      name='joinWaitlist')
+    @instrumented('joinWaitlist')
+    @throttled
+    def join_waitlist(self, request):
+        """Join the waitlist of a sold out conference."""
+        prof = self._get_profile_from_user()
+        wsck = request.websafeConferenceKey
+        conf = ndb.Key(urlsafe=wsck).get()
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % wsck)
+        if wsck in prof.conferenceKeysToAttend:
+            raise ConflictException(
+                "You have already registered for this conference")
+        if conf.seatsAvailable > 0:
+            raise ConflictException(
+                "There are seats available, register instead.")
+
+        # the key is unique per user, so joining twice keeps the original
+        # place in the queue
+        e_key = WaitlistEntry.key_for(wsck, prof.key.id())
+        if not e_key.get():
+            WaitlistEntry(key=e_key, websafeConferenceKey=wsck,
+                          userId=prof.key.id()).put()
+        return BooleanMessage(data=True)
+
+    @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
+                      path='conference/{websafeConferenceKey}/waitlist',
+                      http_method='DELETE',
+                      name='leaveWaitlist')
+    @instrumented('leaveWaitlist')
+    @throttled
+    def leave_waitlist(self, request):
+        """Leave the waitlist of a conference."""
+        prof = self._get_profile_from_user()
+        e_key = WaitlistEntry.key_for(request.websafeConferenceKey,
+                                      prof.key.id())
+        if not e_key.get():
+            return BooleanMessage(data=False)
+        e_key.delete()
+        return BooleanMessage(data=True)
+
+    @staticmethod
+    def _take_seat(entry, conf):
+        """Register the waitlisted user of entry for conf, taking one of
+        its free seats, and delete the entry; return False if the user
+        was registered already. Runs in the caller's transaction, which
+        writes conf."""
+        wsck = conf.key.urlsafe()
+        prof = ndb.Key(Profile, entry.userId).get()
+        entry.key.delete()
+        if not prof or wsck in prof.conferenceKeysToAttend:
+            return False
+        prof.conferenceKeysToAttend.append(wsck)
+        prof.put()
+        conf.seatsAvailable -= 1
+        facets.enqueue(facets.deltas_for(conf, 'registrations', 1),
+                       transactional=True)
+        return True
+
+    @staticmethod
+    @ndb.transactional(xg=True)
+    def _promote_waitlist_entry(e_key, c_key):
+        """Register a waitlisted user if a seat is free; return False once
+        the conference is full again."""
+        entry, conf = ndb.get_multi([e_key, c_key])
+        if not conf or conf.seatsAvailable <= 0:
+            return False
+        if not entry:
+            # left the waitlist meanwhile
+            return True
+
+        if ConferenceApi._take_seat(entry, conf):
+            conf.put()
+        return True
+
+    @staticmethod
+    def _promote_waitlist(wsck):
+        """Move waitlisted users into free seats, oldest first; used by
+        the promote_waitlist task queued by unregisterFromConference."""
+        c_key = ndb.Key(urlsafe=wsck)
+        query = WaitlistEntry.query(
+            WaitlistEntry.websafeConferenceKey == wsck).order(
+            WaitlistEntry.joined)
+
+        # walk the queue with a cursor rather than re-running the query:
+        # it is eventually consistent, and could keep returning entries
+        # just deleted and hide the ones behind them
+        cursor, more = None, True
+        while more:
+            e_keys, cursor, more = query.fetch_page(
+                WAITLIST_PROMOTE_BATCH, start_cursor=cursor, keys_only=True)
+            for e_key in e_keys:
+                if not ConferenceApi._promote_waitlist_entry(e_key, c_key):
+                    return
+
+    # - - - Warmup - - - - - - - - - - - - - - - - - - - - - - - -
+
+    @staticmethod
+    def _warmup():
+        """Prime caches and serialization code paths on a new instance;
+        used by the /_ah/warmup handler. Returns timings in ms."""
+        timings = {}
+
+        def timed(name, func):
+            started = pytime.time()
+            func()
+            timings[name] = int((pytime.time() - started) * 1000)
+
+        timed('announcement', announcement_cache.get)
+        timed('featuredSpeaker', featured_speaker_cache.get)
+        timed('facets', facets.get_counts)
+        timed('publicConferences', ConferenceApi._get_public_conferences)
+        if CATALOG_SNAPSHOT:
+            import catalog
+            timed('catalog', lambda: catalog.snapshot.load_step(
+                catalog.WARMUP_LOAD_SECONDS))
+
+        # encode one of each outbound form so protojson has resolved
+        # every field type before the first real response
+        def encode_forms():
+            for form in (ConferenceForms(items=[ConferenceForm()]),
+                         SessionForms(items=[SessionForm()]),
+                         ConferenceDetailForm(conference=ConferenceForm()),
+                         ConferenceFacetsForm(), ProfileForm(),
+                         BooleanMessage(), StringMessage(data='')):
+                protojson.encode_message(form)
+        timed('messages', encode_forms)
+
+        for name, ms in timings.items():
+            incr('warmup.%s.ms' % name, ms)
+        return timings
+
+    # - - - Public listing - - - - - - - - - - - - - - - - - - - -
+
+    @staticmethod
+    def _render_public_conferences():
+        """Render the anonymous conference listing (same JSON as an
+        unfiltered queryConferences, less the organizers' user IDs,
+        which are email addresses) as (body, etag). Past
+        PUBLIC_LISTING_LIMIT conferences, websafeCursor continues the
+        same query through queryConferences."""
+        confs, cursor, more = Conference.query().order(
+            Conference.name).fetch_page(PUBLIC_LISTING_LIMIT)
+        organisers = ndb.get_multi(
+            [ndb.Key(Profile, conf.organizerUserId) for conf in confs])
+        names = dict((prof.key.id(), prof.displayName)
+                     for prof in organisers if prof)
+
+        api = ConferenceApi()
+        body = protojson.encode_message(ConferenceForms(
+            items=[api._copy_conference_to_form(
+                conf, names.get(conf.organizerUserId), PUBLIC_FIELDS)
+                for conf in confs],
+            websafeCursor=cursor.urlsafe() if more else None,
+        ))
+        return body, hashlib.md5(body).hexdigest()
+
+    @staticmethod
+    def _cache_public_conferences():
+        """Re-render the public listing into memcache; used by the
+        render_public_conferences task."""
+        return public_conferences_cache.refresh()
+
+    @staticmethod
+    def _schedule_public_render():
+        """Queue a re-render of the public listing after a conference
+        change. Tasks are named per interval, so a burst of changes
+        (e.g. registrations) renders once at the end of the interval."""
+        now = pytime.time()
+        interval = int(now // PUBLIC_RENDER_INTERVAL)
+        try:
+            taskqueue.add(
+                name='render-public-conferences-%d' % interval,
+                url='/tasks/render_public_conferences',
+                countdown=(interval + 1) * PUBLIC_RENDER_INTERVAL - now)
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            pass
+
+    @staticmethod
+    def _get_public_conferences():
+        """Return the pre-rendered public listing as (body, etag)."""
+        # only renders here if memcache lost the listing and another
+        # request is already re-rendering it
+        return (public_conferences_cache.get() or
+                ConferenceApi._render_public_conferences())
 
     # - - - Announcements - - - - - - - - - - - - - - - - - - - -
 
     @staticmethod
-    def _cache_announcement():
-        """Create Announcement & assign to memcache; used by
-        memcache cron job & putAnnouncement().
-        """
+    def _make_announcement():
+        """Build the Announcement string from nearly sold out conferences."""
         confs = Conference.query(ndb.AND(
             Conference.seatsAvailable <= 5,
             Conference.seatsAvailable > 0)
         ).fetch(projection=[Conference.name])
 
-        if confs:
-            # If there are almost sold out conferences,
-            # format announcement and set it in memcache
-            announcement = '%s %s' % (
-                'Last chance to attend! The following conferences '
-                'are nearly sold out:',
-                ', '.join(conf.name for conf in confs))
-            memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
-        else:
-            # If there are no sold out conferences,
-            # delete the memcache announcements entry
-            announcement = ""
-            memcache.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
+        if not confs:
+            # no nearly sold out conferences, cache the empty announcement
+            # so it isn't recomputed on every request
+            return ""
+
+        return '%s %s' % (
+            'Last chance to attend! The following conferences '
+            'are nearly sold out:',
+            ', '.join(conf.name for conf in confs))
 
-        return announcement
+    @staticmethod
+    def _cache_announcement():
+        """Create Announcement & assign to memcache; used by
+        memcache cron job & putAnnouncement().
+        """
+        return announcement_cache.refresh()
 
     @endpoints.method(message_types.VoidMessage, StringMessage,
                       path='conference/announcement/get', http_method='GET',
                       name='getAnnouncement')
+    @instrumented('getAnnouncement')
+    @throttled
     def get_announcement(self, request):
-        """Return Announcement from memcache."""
-        return StringMessage(
-            data=memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY) or "")
+        """Return Announcement from cache."""
+        return StringMessage(data=announcement_cache.get() or "")
 
     # - - - Sessions - - - - - - - - - - - - - - - - - - - -
     @staticmethod
-    def _mem_cache_speaker(speaker, wsck):
-        """Cache speaker in Memcache if speaker has more than one session"""
-        # Get conference from given websafe key
-        conf = ndb.Key(urlsafe=wsck).get()
-
-        # Count number of sessions the speaker is speaking in for the specified conference
-        sessions = Session.query(ancestor=conf.key).filter(
-            Session.speaker == speaker).fetch()
-        session_count = len(sessions)
-
-        # if speaker has more than one session, add to memcache
+    def _mem_cache_speaker(speakers, wsck):
+        """Cache the speaker with most sessions among speakers in Memcache
+        if they have more than one session"""
+        c_key = ndb.Key(urlsafe=wsck)
+
+        # Count number of sessions each speaker is speaking in for the
+        # specified conference; a single speaker can be filtered in the query
+        sessions = Session.query(ancestor=c_key)
+        if len(speakers) == 1:
+            sessions = sessions.filter(Session.speaker == speakers[0])
+        counts = Counter(session.speaker for session in sessions
+                         if session.speaker in speakers)
+        if not counts:
+            return
+        speaker, session_count = counts.most_common(1)[0]
+
+        # if speaker has more than one session, record it so the cache
+        # can be rebuilt after eviction, then add to memcache
         if session_count > 1:
-            memcache.set(MEMCACHE_FEATURED_SPEAKER_KEY,
-                         "Featured Speaker: %s" % speaker)
+            FeaturedSpeaker(id=FEATURED_SPEAKER_ID, speaker=speaker,
+                            websafeConferenceKey=wsck).put()
+            featured_speaker_cache.set("Featured Speaker: %s" % speaker)
 
-    def _create_session_object(self, request):
-        """Create or update Session object, returning SessionForm/request"""
+    @staticmethod
+    def _make_featured_speaker():
+        """Build the Featured Speaker string from the last recorded one."""
+        featured = ndb.Key(FeaturedSpeaker, FEATURED_SPEAKER_ID).get()
+        if not featured:
+            return ""
+        return "Featured Speaker: %s" % featured.speaker
+
+    def _get_session_conference(self, wsck):
+        """Return Conference for wsck, checking that the current user owns it"""
         user = endpoints.get_current_user()
         if not user:
             raise endpoints.UnauthorizedException("Authorization required")
 
         # get Conference object from request; bail if not found
-        c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        c_key = ndb.Key(urlsafe=wsck)
         conf = c_key.get()
         if not conf:
             raise endpoints.NotFoundException(
-                "No conference found with key: %s" % request.websafeConferenceKey)
+                "No conference found with key: %s" % wsck)
 
-        # Check if user is authorized to create sessions for this conference
-        user_id = get_user_id(user)
-        p_key = ndb.Key(Profile, user_id)
-
-        profile = p_key.get()
-        c_owner = conf.key.parent().get()
-        if profile is not c_owner:
+        # Check if user is authorized to create sessions for this conference;
+        # the conference is a child of its owner's Profile
+        if c_key.parent() != ndb.Key(Profile, get_user_id(user)):
             raise endpoints.UnauthorizedException(
                 "Sessions can be only created by conference owner")
+        return conf
 
-        if not request.name:
+    def _session_data_from_form(self, form):
+        """Validate SessionForm and convert it into Session properties"""
+        if not form.name:
             raise endpoints.BadRequestException("Name field required")
 
-        if not request.speaker:
+        if not form.speaker:
             raise endpoints.BadRequestException("Speaker field required")
 
         # copy SessionForm/ProtoRPC Message into dict
-        data = {field.name: getattr(request, field.name) for field in
-                request.all_fields()}
+        data = {field.name: getattr(form, field.name) for field in
+                form.all_fields()}
         del data['websafeConferenceKey']
         del data['websafeSessionKey']
 
@@ -630,9 +1405,15 @@ class ConferenceApi(remote.Service):
         if data["startTime"]:
             data["startTime"] = datetime.strptime(data["startTime"][:5],
                                                   "%H:%M").time()
+        return data
+
+    def _create_session_object(self, request):
+        """Create or update Session object, returning SessionForm/request"""
+        conf = self._get_session_conference(request.websafeConferenceKey)
+        data = self._session_data_from_form(request)
 
-        s_id = Session.allocate_ids(size=1, parent=c_key)[0]
-        s_key = ndb.Key(Session, s_id, parent=c_key)
+        s_id = Session.allocate_ids(size=1, parent=conf.key)[0]
+        s_key = ndb.Key(Session, s_id, parent=conf.key)
         data["key"] = s_key
 
         session = Session(**data)
@@ -644,16 +1425,60 @@ class ConferenceApi(remote.Service):
 
         return self._copy_session_to_form(session)
 
+    def _create_session_objects(self, request):
+        """Create Session objects in bulk, returning SessionForms"""
+        conf = self._get_session_conference(request.websafeConferenceKey)
+        if not request.items:
+            raise endpoints.BadRequestException("At least one session required")
+        if len(request.items) > CREATE_SESSIONS_LIMIT:
+            raise endpoints.BadRequestException(
+                "At most %d sessions can be created at once" %
+                CREATE_SESSIONS_LIMIT)
+
+        # validate everything before allocating ids or writing anything
+        datas = [self._session_data_from_form(form) for form in request.items]
+
+        # allocate the whole id range in one call
+        first, last = Session.allocate_ids(size=len(datas), parent=conf.key)
+        sessions = []
+        for s_id, data in zip(range(first, last + 1), datas):
+            data["key"] = ndb.Key(Session, s_id, parent=conf.key)
+            sessions.append(Session(**data))
+        ndb.put_multi(sessions)
+
+        # recompute the featured speaker once for the whole agenda
+        taskqueue.add(params={'speaker': sorted(set(s.speaker for s in sessions)),
+                              'websafeConferenceKey': request.websafeConferenceKey},
+                      url='/tasks/set_featured_speaker')
+
+        return SessionForms(
+            items=[self._copy_session_to_form(session) for session in sessions]
+        )
+
     @endpoints.method(SessionForm, SessionForm, path='session',
                       http_method='POST', name='createSession')
+    @instrumented('createSession')
+    @throttled
     def create_session(self, request):
         """Create new session"""
         return self._create_session_object(request)
 
-    def _copy_session_to_form(self, session):
-        """Copy relevant fields from Session to SessionForm."""
+    @endpoints.method(SESSIONS_POST_REQUEST, SessionForms,
+                      path='sessions/{websafeConferenceKey}',
+                      http_method='POST', name='createSessions')
+    @instrumented('createSessions')
+    @throttled
+    def create_sessions(self, request):
+        """Create many sessions for selected conference in one call"""
+        return self._create_session_objects(request)
+
+    def _copy_session_to_form(self, session, fields=None):
+        """Copy relevant fields from Session to SessionForm, only those in
+        fields if given."""
         sf = SessionForm()
         for field in sf.all_fields():
+            if fields is not None and field.name not in fields:
+                continue
             if hasattr(session, field.name):
                 # convert Date to date string; just copy others
                 if field.name == 'date' or field.name == 'startTime':
@@ -669,56 +1494,94 @@ class ConferenceApi(remote.Service):
     @endpoints.method(SESSION_GET_REQUEST, SessionForms,
                       path='sessions/{websafeConferenceKey}',
                       http_method='GET', name='getConferenceSessions')
+    @instrumented('getConferenceSessions')
+    @throttled
     def get_conference_sessions(self, request):
         """Get all sessions for selected conference"""
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        conf = archive.get(ndb.Key(urlsafe=request.websafeConferenceKey))
         if not conf:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % request.websafeConferenceKey)
 
         # query all sessions for conference
-        sessions = Session.query(ancestor=conf.key).fetch()
+        if archive.is_archived(conf.key):
+            sessions = archive.get_sessions(conf.key)
+        else:
+            sessions = Session.query(ancestor=conf.key).fetch()
 
         # return set of SessionForm objects per Session
-        return SessionForms(
-            items=[self._copy_session_to_form(session) for session in sessions]
-        )
+        return self._session_list(sessions, request, 'getConferenceSessions')
+
+    @endpoints.method(WebsafeKeysForm, SessionResultForms,
+                      path='getSessionsByKeys', http_method='POST',
+                      name='getSessionsByKeys')
+    @instrumented('getSessionsByKeys')
+    @throttled
+    def get_sessions_by_keys(self, request):
+        """Return sessions by websafeSessionKey, in request order, marking
+        keys that are invalid or not found instead of failing."""
+        decoded = self._decode_websafe_keys(request.websafeKeys, 'Session')
+        keys = list(set(key for key, _ in decoded if key))
+        sessions = dict(zip(keys, ndb.get_multi(keys)))
+
+        items = []
+        for wsk, (key, error) in zip(request.websafeKeys, decoded):
+            result = SessionResultForm(websafeKey=wsk)
+            session = sessions.get(key) if key else None
+            if error:
+                result.error = error
+            elif not session:
+                result.notFound = True
+            else:
+                result.session = self._copy_session_to_form(session)
+            items.append(result)
+        return SessionResultForms(items=items)
 
     @endpoints.method(SESSION_GET_BY_TYPE_REQUEST, SessionForms,
                       path='sessions/{websafeConferenceKey}/type/{typeOfSession}',
                       http_method='GET', name='getConferenceSessionsByType')
+    @instrumented('getConferenceSessionsByType')
+    @throttled
     def get_conference_sessions_by_type(self, request):
         """Get all sessions of specified type for selected conference"""
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        conf = archive.get(ndb.Key(urlsafe=request.websafeConferenceKey))
         if not conf:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % request.websafeConferenceKey)
 
-        # query all sessions for conference, filter results by typeOfSession
-        sessions = Session.query(ancestor=conf.key).filter(
-            Session.typeOfSession == request.typeOfSession).fetch()
+        # query all sessions for conference, filter results by typeOfSession;
+        # an archived conference's sessions are filtered in memory
+        if archive.is_archived(conf.key):
+            sessions = [s for s in archive.get_sessions(conf.key)
+                        if s.typeOfSession == request.typeOfSession]
+        else:
+            sessions = Session.query(ancestor=conf.key).filter(
+                Session.typeOfSession == request.typeOfSession).fetch()
         if not sessions:
             raise endpoints.NotFoundException(
                 'No sessions found with type: %s' % request.typeOfSession)
 
-        return SessionForms(
-            items=[self._copy_session_to_form(session) for session in sessions]
-        )
+        return self._session_list(sessions, request,
+                                  'getConferenceSessionsByType')
 
     @endpoints.method(SESSION_GET_BY_SPEAKER_REQUEST, SessionForms,
                       path='sessions/speaker/{speaker}',
                       http_method='GET', name='getSessionsBySpeaker')
+    @instrumented('getSessionsBySpeaker')
+    @throttled
     def get_sessions_by_speaker(self, request):
-        """Get all sessions for selected speaker"""
-        sessions = Session.query(Session.speaker == request.speaker).fetch()
+        """Get all sessions for selected speaker; continue a long result
+        with the returned websafeCursor"""
+        sessions, cursor = self._fetch_within_budget(
+            Session.query(Session.speaker == request.speaker), request,
+            'getSessionsBySpeaker')
 
-        if not sessions:
+        if not sessions and not cursor and not request.websafeCursor:
             raise endpoints.NotFoundException(
                 'No sessions found with speaker: %s' % request.speaker)
 
-        return SessionForms(
-            items=[self._copy_session_to_form(session) for session in sessions]
-        )
+        return self._session_list(sessions, request, 'getSessionsBySpeaker',
+                                  cursor)
 
     # - - - Wish List - - - - - - - - - - - - - - - - - - - -
     def _add_session_to_profile_wishlist(self, request, add_session=True):
@@ -757,38 +1620,63 @@ class ConferenceApi(remote.Service):
                 retval = False
 
         # write things back to the datastore & return
-        prof.put()
+        prof.put_if_changed()
         return BooleanMessage(data=retval)
 
     @endpoints.method(WISHLIST_POST_REQUEST, BooleanMessage,
                       path='profile/wishlist/{websafeSessionKey}',
                       http_method='POST', name='addSessionToWishlist')
+    @instrumented('addSessionToWishlist')
+    @throttled
     def add_session_to_wishlist(self, request):
         """Add session to Profile wishlist"""
         return self._add_session_to_profile_wishlist(request)
 
-    @endpoints.method(message_types.VoidMessage, SessionForms,
+    @endpoints.method(LIST_GET_REQUEST, SessionForms,
                       path='profile/wishlist', http_method='GET',
                       name='getSessionsWishlist')
+    @instrumented('getSessionsWishlist')
+    @throttled
     def get_sessions_wishlist(self, request):
         """Get list of sessions in user's wish list"""
         # retrieve sessions
         prof = self._get_profile_from_user()
         session_keys = [ndb.Key(urlsafe=wssk) for wssk in
                         prof.sessionKeysWishList]
-        sessions = ndb.get_multi(session_keys)
+        # sessions of archived conferences are no longer entities
+        sessions = [s for s in ndb.get_multi(session_keys) if s]
 
         if not sessions:
             raise endpoints.NotFoundException('No sessions found in wish list')
 
+        return self._session_list(sessions, request, 'getSessionsWishlist')
+
+    @endpoints.method(SESSION_RECOMMENDED_GET_REQUEST, SessionForms,
+                      path='session/{websafeSessionKey}/recommended',
+                      http_method='GET', name='getRecommendedSessions')
+    @instrumented('getRecommendedSessions')
+    @throttled
+    def get_recommended_sessions(self, request):
+        """Get sessions often wishlisted together with this session"""
+        # precomputed by the recommend_sessions cron job
+        recs = ndb.Key(SessionRecommendations,
+                       request.websafeSessionKey).get()
+        if not recs:
+            return SessionForms(items=[])
+        session_keys = [ndb.Key(urlsafe=wssk)
+                        for wssk in recs.websafeSessionKeys]
+        sessions = [s for s in ndb.get_multi(session_keys) if s]
         return SessionForms(
-            items=[self._copy_session_to_form(session) for session in sessions]
+            items=[self._copy_session_to_form(session)
+                   for session in sessions]
         )
 
     # - - - Additional Queries - - - - - - - - - - - - - - - - - - - -
     @endpoints.method(SESSION_GET_BY_DATE_REQUEST, SessionForms,
                       path='sessions/date/{date}', http_method='GET',
                       name='getSessionsByDate')
+    @instrumented('getSessionsByDate')
+    @throttled
     def get_sessions_on_date(self, request):
         """Get all sessions for specified date"""
         # convert query date from string to date object
@@ -802,64 +1690,88 @@ class ConferenceApi(remote.Service):
             raise endpoints.NotFoundException(
                 'No sessions found with date: %s' % request.date)
 
-        return SessionForms(
-            items=[self._copy_session_to_form(session) for session in sessions]
-        )
+        return self._session_list(sessions, request, 'getSessionsByDate')
 
     @endpoints.method(SESSION_GET_BY_NOT_TYPE_REQUEST, SessionForms,
                       path='sessions/{websafeConferenceKey}/exclude/{excludedTypeOfSession}',
                       http_method='GET',
                       name='getConferenceSessionsByTypeExcluded')
+    @instrumented('getConferenceSessionsByTypeExcluded')
+    @throttled
     def get_sessions_exclude_type(self, request):
         """Get all sessions excluding specified type for selected conference"""
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        conf = archive.get(ndb.Key(urlsafe=request.websafeConferenceKey))
         if not conf:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % request.websafeConferenceKey)
 
-        # query all sessions for conference
-        sessions = Session.query(ancestor=conf.key).filter(
-            Session.typeOfSession != request.excludedTypeOfSession).fetch()
+        # query all sessions for conference; an archived conference's
+        # sessions are filtered in memory
+        if archive.is_archived(conf.key):
+            sessions = [s for s in archive.get_sessions(conf.key)
+                        if s.typeOfSession != request.excludedTypeOfSession]
+        else:
+            sessions = Session.query(ancestor=conf.key).filter(
+                Session.typeOfSession != request.excludedTypeOfSession).fetch()
 
         if not sessions:
             raise endpoints.NotFoundException(
                 'No sessions found for specified request')
 
-        return SessionForms(
-            items=[self._copy_session_to_form(session) for session in sessions]
-        )
+        return self._session_list(sessions, request,
+                                  'getConferenceSessionsByTypeExcluded')
 
-    @endpoints.method(message_types.VoidMessage, SessionForms,
+    @endpoints.method(SESSION_PAGE_REQUEST, SessionForms,
                       path='sessions/non-workshop/before-seven',
                       http_method='GET',
                       name='getSessionsNonWorkshopBeforeSeven')
+    @instrumented('getSessionsNonWorkshopBeforeSeven')
+    @throttled
     def get_sessions_non_workshop_before_seven(self, request):
-        """Get all sessions that aren't workshops and start before 7:00 PM"""
-        # query all for non-workshop sessions
-        sessions = Session.query(Session.typeOfSession != "workshop").fetch()
-
-        if not sessions:
+        """Get all sessions that aren't workshops and start before 7:00 PM;
+        continue a long result with the returned websafeCursor"""
+        # only one inequality per query: filter on startTime in the query,
+        # which keeps it a single cursor-friendly index scan, and drop the
+        # workshops in memory, and the sessions without a startTime, which
+        # sort before every time
+        query = Session.query(Session.startTime < time(19, 00)).order(
+            Session.startTime)
+        sessions, cursor = self._fetch_within_budget(
+            query, request, 'getSessionsNonWorkshopBeforeSeven',
+            keep=lambda session: (session.startTime is not None and
+                                  session.typeOfSession != "workshop"))
+
+        if not sessions and not cursor and not request.websafeCursor:
             raise endpoints.NotFoundException(
                 'No sessions found for specified request')
 
-        # filter out sessions > 7:00 PM
-        filtered_sessions = [session for session in sessions if
-                             session.startTime and session.startTime < time(19,
-                                                                            00)]
-
-        return SessionForms(
-            items=[self._copy_session_to_form(session) for session in
-                   filtered_sessions]
-        )
+        return self._session_list(sessions, request,
+                                  'getSessionsNonWorkshopBeforeSeven', cursor)
 
     # - - - Featured Speaker - - - - - - - - - - - - - - - - - - - -
     @endpoints.method(message_types.VoidMessage, StringMessage,
                       path='speaker/featured', http_method='GET',
                       name='getFeaturedSpeaker')
+    @instrumented('getFeaturedSpeaker')
+    @throttled
     def get_featured_speaker(self, request):
-        """Return Featured Speaker from memcache."""
-        return StringMessage(
-            data=memcache.get(MEMCACHE_FEATURED_SPEAKER_KEY) or "")
-
+        """Return Featured Speaker from cache."""
+        return StringMessage(data=featured_speaker_cache.get() or "")
+
+
+# stale-while-revalidate caches; the announcement cron refreshes hourly
+announcement_cache = SWRCache(MEMCACHE_ANNOUNCEMENTS_KEY,
+                              ConferenceApi._make_announcement,
+                              fresh_for=3600, stale_for=24 * 3600,
+                              default="")
+featured_speaker_cache = SWRCache(MEMCACHE_FEATURED_SPEAKER_KEY,
+                                  ConferenceApi._make_featured_speaker,
+                                  fresh_for=600, stale_for=24 * 3600,
+                                  default="")
+
+# pre-rendered on every conference change; the expiry is only a backstop
+public_conferences_cache = SWRCache(MEMCACHE_PUBLIC_CONFERENCES_KEY,
+                                    ConferenceApi._render_public_conferences,
+                                    fresh_for=3600, stale_for=24 * 3600)
 
 api = endpoints.api_server([ConferenceApi])  # register API
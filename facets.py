@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+"""facets.py
+
+Udacity conference server-side Python App Engine facet counters;
+    sharded counts of conferences and registrations per city, topic
+    and start month, updated off the request path by a task
+
+$Id$
+
+"""
+
+import json
+import random
+from datetime import datetime, timedelta
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from cache import SWRCache
+from models import FacetCounterShard
+from models import FacetTaskMarker
+
+NUM_SHARDS = 20
+MEMCACHE_FACETS_KEY = "CONFERENCE_FACETS"
+TOTAL = 'total'
+# shards updated per transaction, leaving one entity group of the 25 an
+# XG transaction may touch for the FacetTaskMarker
+DELTAS_PER_TRANSACTION = 24
+# task retries stop long before this
+MARKER_RETENTION = timedelta(days=1)
+
+
+def facet_values(conf):
+    """Return the (dimension, value) pairs a Conference is counted under."""
+    values = [(TOTAL, '')]
+    if conf.city:
+        values.append(('city', conf.city))
+    for topic in set(conf.topics or []):
+        values.append(('topic', topic))
+    if conf.month:
+        values.append(('month', str(conf.month)))
+    return values
+
+
+def registered(conf):
+    """Return the number of seats taken in a Conference."""
+    return (conf.maxAttendees or 0) - (conf.seatsAvailable or 0)
+
+
+def deltas_for(conf, metric, delta):
+    """Return the counter deltas that add delta to every facet of conf;
+    none until the counters include conf, as a change to a conference
+    they don't count yet would leave them off by that change."""
+    if not conf.facetsCounted:
+        return []
+    return [[metric, dimension, value, delta]
+            for dimension, value in facet_values(conf)]
+
+
+def merge(deltas):
+    """Sum deltas for the same counter and drop the ones that cancel out."""
+    totals = {}
+    for metric, dimension, value, delta in deltas:
+        key = (metric, dimension, value)
+        totals[key] = totals.get(key, 0) + delta
+    return [list(key) + [delta] for key, delta in sorted(totals.items())
+            if delta]
+
+
+def enqueue(deltas, transactional=False):
+    """Queue the update_facets task; pass transactional=True inside a
+    transaction so counts only move if it commits."""
+    deltas = merge(deltas)
+    if deltas:
+        taskqueue.add(params={'deltas': json.dumps(deltas)},
+                      url='/tasks/update_facets',
+                      transactional=transactional)
+
+
+@ndb.transactional(xg=True)
+def _increment_shards(deltas, marker_key):
+    if marker_key and marker_key.get():
+        # applied by an earlier attempt of the same task
+        return
+    keys = [ndb.Key(FacetCounterShard, '%s|%s|%s|%d' % (
+        metric, dimension, value, random.randrange(NUM_SHARDS)))
+        for metric, dimension, value, _ in deltas]
+    shards = ndb.get_multi(keys)
+    for i, (metric, dimension, value, delta) in enumerate(deltas):
+        if not shards[i]:
+            shards[i] = FacetCounterShard(key=keys[i], metric=metric,
+                                          dimension=dimension, value=value,
+                                          count=0)
+        shards[i].count += delta
+    if marker_key:
+        shards.append(FacetTaskMarker(key=marker_key))
+    ndb.put_multi(shards)
+
+
+def apply_deltas(deltas, task_name=None):
+    """Apply deltas to a random shard of each counter; used by the
+    update_facets task. With the task's name, each chunk of deltas is
+    applied together with a marker, so a retry skips what it already
+    applied."""
+    for start in range(0, len(deltas), DELTAS_PER_TRANSACTION):
+        marker_key = task_name and ndb.Key(
+            FacetTaskMarker, '%s|%d' % (task_name, start))
+        _increment_shards(deltas[start:start + DELTAS_PER_TRANSACTION],
+                          marker_key)
+
+
+def prune_markers():
+    """Delete FacetTaskMarkers older than MARKER_RETENTION."""
+    cutoff = datetime.utcnow() - MARKER_RETENTION
+    ndb.delete_multi(FacetTaskMarker.query(
+        FacetTaskMarker.applied < cutoff).fetch(keys_only=True))
+
+
+def _sum_shards():
+    """Sum every shard into {(metric, dimension, value): count}. The number
+    of shards depends on the distinct facet values, not on how many
+    conferences there are."""
+    counts = {}
+    for shard in FacetCounterShard.query():
+        key = (shard.metric, shard.dimension, shard.value)
+        counts[key] = counts.get(key, 0) + shard.count
+    return counts
+
+
+facets_cache = SWRCache(MEMCACHE_FACETS_KEY, _sum_shards,
+                        fresh_for=60, stale_for=3600, default={})
+
+
+def get_counts():
+    """Return {(metric, dimension, value): count}, at most a minute old."""
+    return facets_cache.get()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+"""instrumentation.py
+
+Udacity conference server-side Python App Engine API instrumentation;
+    per instance counters and latencies for ConferenceApi methods, and
+    optional trace lines that tools/loadgen.py can replay
+
+$Id$
+
+"""
+
+import functools
+import json
+import logging
+import threading
+import time
+
+import endpoints
+from protorpc import protojson
+
+from settings import TRACE_API_CALLS
+
+TRACE_PREFIX = 'TRACE '
+
+_lock = threading.Lock()
+_counters = {}
+
+
+def incr(name, delta=1):
+    """Add delta to the named counter."""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + delta
+
+
+def snapshot():
+    """Return a copy of all counters."""
+    with _lock:
+        return dict(_counters)
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+
+
+def _trace(method_name, request, started):
+    """Log the call in the format read by tools/loadgen.py."""
+    user = endpoints.get_current_user()
+    logging.info('%s%s', TRACE_PREFIX, json.dumps({
+        'method': method_name,
+        'params': json.loads(protojson.encode_message(request)),
+        'user': user.email() if user else None,
+        'ts': started,
+    }))
+
+
+def instrumented(method_name):
+    """Count calls, errors and latency of an API method, keyed by its
+    Endpoints name, and trace the call if TRACE_API_CALLS is set."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, request):
+            started = time.time()
+            if TRACE_API_CALLS:
+                _trace(method_name, request, started)
+            try:
+                return func(self, request)
+            except Exception as e:
+                incr('%s.error.%s' % (method_name, e.__class__.__name__))
+                raise
+            finally:
+                incr('%s.calls' % method_name)
+                incr('%s.ms' % method_name,
+                     int((time.time() - started) * 1000))
+        return wrapper
+    return decorator
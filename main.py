@@ -12,10 +12,15 @@ created by wesc on 2014 may 24
 
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
+import json
+import logging
+
 import webapp2
-from google.appengine.api import app_identity
-from google.appengine.api import mail
 from conference import ConferenceApi
+import archive
+import facets
+import instrumentation
+import mapper
 
 
 class SetAnnouncementHandler(webapp2.RequestHandler):
@@ -29,6 +34,9 @@ class SetAnnouncementHandler(webapp2.RequestHandler):
 class SendConfirmationEmailHandler(webapp2.RequestHandler):
     def post(self):
         """Send email confirming Conference creation."""
+        # only this task sends mail, so keep it out of instance start up
+        from google.appengine.api import app_identity
+        from google.appengine.api import mail
         mail.send_mail(
             'noreply@%s.appspotmail.com' % (app_identity.get_application_id()),
             # from
@@ -43,14 +51,137 @@ class SendConfirmationEmailHandler(webapp2.RequestHandler):
 class SetFeaturedSpeakerHandler(webapp2.RequestHandler):
     def post(self):
         """Set Featured Speaker in Memcache."""
-        speaker = self.request.get('speaker')
+        speakers = self.request.get_all('speaker')
+        wsck = self.request.get('websafeConferenceKey')
+        ConferenceApi._mem_cache_speaker(speakers, wsck)
+        self.response.set_status(204)
+
+
+class PromoteWaitlistHandler(webapp2.RequestHandler):
+    def post(self):
+        """Register waitlisted users for freed conference seats."""
         wsck = self.request.get('websafeConferenceKey')
-        ConferenceApi._mem_cache_speaker(speaker, wsck)
+        ConferenceApi._promote_waitlist(wsck)
+        ConferenceApi._schedule_public_render()
+        self.response.set_status(204)
+
+
+class UpdateFacetsHandler(webapp2.RequestHandler):
+    def post(self):
+        """Apply conference facet counter deltas."""
+        facets.apply_deltas(json.loads(self.request.get('deltas')),
+                            self.request.headers.get('X-AppEngine-TaskName'))
+        self.response.set_status(204)
+
+
+class ArchiveConferencesHandler(webapp2.RequestHandler):
+    def get(self):
+        """Move ended conferences to the archive (cron)."""
+        archive.run()
+        facets.prune_markers()
+        ConferenceApi._schedule_public_render()
+        self.response.set_status(204)
+
+    def post(self):
+        """Continue archiving where the previous batch stopped."""
+        archive.run()
+        ConferenceApi._schedule_public_render()
         self.response.set_status(204)
 
 
+class RecommendSessionsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Recompute session recommendations from wishlists."""
+        # numpy is only needed here, so keep it out of instance start up
+        import recommendations
+        count = recommendations.compute()
+        logging.info('Recommendations computed for %d sessions', count)
+        self.response.set_status(204)
+
+
+class PublicConferencesHandler(webapp2.RequestHandler):
+    def get(self):
+        """Serve the pre-rendered anonymous conference listing."""
+        body, etag = ConferenceApi._get_public_conferences()
+        # identical for every visitor, so shared caches may keep it; it
+        # is re-rendered within seconds of a change
+        self.response.headers['Cache-Control'] = 'public, max-age=60'
+        self.response.headers['Vary'] = 'Accept-Encoding'
+        self.response.headers['ETag'] = '"%s"' % etag
+        if etag in self.request.if_none_match:
+            self.response.set_status(304)
+            return
+        self.response.headers['Content-Type'] = \
+            'application/json; charset=utf-8'
+        self.response.write(body)
+
+
+class RenderPublicConferencesHandler(webapp2.RequestHandler):
+    def post(self):
+        """Re-render the public conference listing into memcache."""
+        ConferenceApi._cache_public_conferences()
+        self.response.set_status(204)
+
+
+class MappersHandler(webapp2.RequestHandler):
+    def get(self):
+        """Return progress and throughput of recent mapper jobs."""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(
+            [mapper.status(job_key) for job_key in mapper.recent_jobs()],
+            sort_keys=True))
+
+    def post(self):
+        """Start a mapper job: name, optional shards and params (JSON)."""
+        name = self.request.get('name')
+        if name not in mapper.MAPPERS:
+            self.abort(400, 'Unknown mapper: %s' % name)
+        job_key = mapper.start(
+            name, int(self.request.get('shards') or mapper.DEFAULT_SHARDS),
+            json.loads(self.request.get('params') or '{}'))
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps({'job': job_key.id()}))
+
+
+class MapperSliceHandler(webapp2.RequestHandler):
+    def post(self):
+        """Run one slice of a mapper shard."""
+        mapper.run_slice(int(self.request.get('job')),
+                         int(self.request.get('shard')),
+                         int(self.request.get('slice')))
+        self.response.set_status(204)
+
+
+class CountersHandler(webapp2.RequestHandler):
+    def get(self):
+        """Return this instance's API and rate limit counters."""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(instrumentation.snapshot(),
+                                       sort_keys=True))
+
+
+class WarmupHandler(webapp2.RequestHandler):
+    def get(self):
+        """Prime caches before the instance receives user traffic."""
+        # importing this module has already loaded conference.py
+        timings = ConferenceApi._warmup()
+        logging.info('Warmup: %s', json.dumps(timings))
+        self.response.set_status(200)
+
+
 app = webapp2.WSGIApplication([
+    ('/public/conferences', PublicConferencesHandler),
+    ('/_ah/warmup', WarmupHandler),
+    ('/admin/counters', CountersHandler),
+    ('/admin/mappers', MappersHandler),
     ('/crons/set_announcement', SetAnnouncementHandler),
+    ('/crons/archive_conferences', ArchiveConferencesHandler),
+    ('/crons/recommend_sessions', RecommendSessionsHandler),
     ('/tasks/send_confirmation_email', SendConfirmationEmailHandler),
-    ('/tasks/set_featured_speaker', SetFeaturedSpeakerHandler)
+    ('/tasks/set_featured_speaker', SetFeaturedSpeakerHandler),
+    ('/tasks/promote_waitlist', PromoteWaitlistHandler),
+    ('/tasks/update_facets', UpdateFacetsHandler),
+    ('/tasks/archive_conferences', ArchiveConferencesHandler),
+    ('/tasks/render_public_conferences', RenderPublicConferencesHandler),
+    ('/tasks/mapper', MapperSliceHandler)
 ], debug=True)
@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+
+"""mapper.py
+
+Udacity conference server-side Python App Engine mapper framework;
+    runs a function over every entity of a kind in parallel task queue
+    shards, for backfills and consistency checks
+
+A job splits the kind into key ranges from a sample of __scatter__ keys.
+Each range is a shard, processed as a chain of task slices. A slice
+walks its range in key order with a query cursor and hands each entity
+to Mapper.map(). The entities map() returns are written with batched
+put_multi() / delete_multi(). After every batch the cursor and counts
+are checkpointed in the shard's MapperShard entity. A retried or
+restarted slice resumes from there, so map() must be idempotent.
+
+Jobs are started and watched through /admin/mappers.
+
+$Id$
+
+"""
+
+import logging
+import time
+
+from google.appengine.api import datastore
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+import facets
+from models import Conference
+from models import MapperJob
+from models import MapperShard
+from models import Profile
+from models import Session
+
+DEFAULT_SHARDS = 8
+MAX_SHARDS = 64
+# __scatter__ keys sampled per shard when choosing split points
+OVERSAMPLE = 32
+BATCH_SIZE = 100
+# tasks may run for 10 minutes; keep slices well inside that
+SLICE_SECONDS = 60
+
+
+class Mapper(object):
+    """Mapper -- base class of mapper jobs.
+
+    Subclasses set MODEL and implement map(), which returns (to_put,
+    to_delete) lists of entities and keys. Use count() to report
+    counters. params holds the job's parameters.
+    """
+    MODEL = None
+
+    def __init__(self, params=None):
+        self.params = params or {}
+        self.counters = {}
+
+    def map(self, entity):
+        raise NotImplementedError
+
+    def count(self, name, delta=1):
+        self.counters[name] = self.counters.get(name, 0) + delta
+
+
+# - - - key ranges - - - - - - - - - - - - - - - - - - - - - - - -
+
+def split_key_ranges(kind, shards):
+    """Return shards (start, end) key pairs covering the whole kind, with
+    None for an open end, from a sample of __scatter__ keys."""
+    query = datastore.Query(kind, keys_only=True)
+    query.Order('__scatter__')
+    sample = sorted(ndb.Key.from_old_key(key)
+                    for key in query.Get(shards * OVERSAMPLE))
+    if len(sample) < shards:
+        # too few entities to bother splitting
+        return [(None, None)]
+    step = len(sample) / float(shards)
+    splits = [sample[int(step * i)] for i in range(1, shards)]
+    bounds = [None] + splits + [None]
+    return zip(bounds[:-1], bounds[1:])
+
+
+def _range_query(model, start, end):
+    q = model.query()
+    if start:
+        q = q.filter(model.key >= start)
+    if end:
+        q = q.filter(model.key < end)
+    return q.order(model.key)
+
+
+# - - - jobs - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+def start(name, shards=DEFAULT_SHARDS, params=None):
+    """Start the mapper registered under name; return the job key."""
+    mapper_class = MAPPERS[name]
+    shards = max(1, min(shards, MAX_SHARDS))
+    ranges = split_key_ranges(mapper_class.MODEL._get_kind(), shards)
+
+    job = MapperJob(name=name, params=params or {}, shards=len(ranges))
+    job.put()
+    states = [MapperShard(key=ndb.Key(MapperShard, i + 1, parent=job.key),
+                          startKey=start_key, endKey=end_key)
+              for i, (start_key, end_key) in enumerate(ranges)]
+    ndb.put_multi(states)
+    for state in states:
+        _enqueue_slice(state)
+    logging.info('Mapper %s started as job %d with %d shards',
+                  name, job.key.id(), len(states))
+    return job.key
+
+
+def _slice_params(state):
+    return {'job': state.key.parent().id(), 'shard': state.key.id(),
+            'slice': state.slices}
+
+
+def _enqueue_slice(state):
+    # named after the slice, so a retried enqueue doesn't fork the shard
+    try:
+        taskqueue.add(url='/tasks/mapper',
+                      name='mapper-%d-%d-%d' % (
+                          state.key.parent().id(), state.key.id(),
+                          state.slices),
+                      params=_slice_params(state))
+    except (taskqueue.TaskAlreadyExistsError,
+            taskqueue.TombstonedTaskError):
+        pass
+
+
+@ndb.transactional
+def _chain_slice(shard_key, slice_number):
+    """Advance the shard past slice_number and queue the next slice in
+    the same transaction, so one can't happen without the other. The
+    task is unnamed, as transactional tasks must be; run_slice's slice
+    check drops duplicates."""
+    state = shard_key.get()
+    if state.slices != slice_number:
+        return
+    state.slices += 1
+    state.put()
+    taskqueue.add(url='/tasks/mapper', params=_slice_params(state),
+                  transactional=True)
+
+
+def run_slice(job_id, shard_id, slice_number):
+    """Process one slice of a shard and chain the next; used by the
+    mapper task."""
+    job_key = ndb.Key(MapperJob, job_id)
+    job, state = ndb.get_multi([job_key,
+                                ndb.Key(MapperShard, shard_id,
+                                        parent=job_key)])
+    # a stale task for a slice that has already been chained past
+    if not job or not state or state.done or state.slices != slice_number:
+        return
+    mapper = MAPPERS[job.name](job.params)
+    query = _range_query(mapper.MODEL, state.startKey, state.endKey)
+    cursor = state.cursor and ndb.Cursor(urlsafe=state.cursor)
+
+    started = time.time()
+    deadline = started + SLICE_SECONDS
+    processed = state.processed
+    more = True
+    while more and time.time() < deadline:
+        entities, cursor, more = query.fetch_page(BATCH_SIZE,
+                                                  start_cursor=cursor)
+        to_put, to_delete = [], []
+        for entity in entities:
+            puts, deletes = mapper.map(entity)
+            to_put.extend(puts or [])
+            to_delete.extend(deletes or [])
+        ndb.put_multi(to_put)
+        ndb.delete_multi(to_delete)
+
+        # checkpoint after every batch
+        state.cursor = cursor.urlsafe() if more and cursor else None
+        state.processed += len(entities)
+        state.written += len(to_put) + len(to_delete)
+        counters = dict(state.counters or {})
+        for name, delta in mapper.counters.items():
+            counters[name] = counters.get(name, 0) + delta
+        state.counters = counters
+        mapper.counters = {}
+        state.done = not more
+        state.put()
+
+    logging.info('Mapper job %d shard %d slice %d: %d entities, %.1f/s',
+                 job_id, shard_id, slice_number, state.processed - processed,
+                 (state.processed - processed) /
+                 max(time.time() - started, 0.001))
+    if not state.done:
+        _chain_slice(state.key, slice_number)
+    else:
+        logging.info('Mapper job %d shard %d done: %d entities',
+                     job_id, shard_id, state.processed)
+
+
+def status(job_key):
+    """Return a dict describing the job's progress and throughput."""
+    job = job_key.get()
+    states = MapperShard.query(ancestor=job_key).fetch()
+    processed = sum(state.processed for state in states)
+    counters = {}
+    for state in states:
+        for name, count in (state.counters or {}).items():
+            counters[name] = counters.get(name, 0) + count
+    last = max([state.updated for state in states] or [job.started])
+    elapsed = max((last - job.started).total_seconds(), 0.001)
+    return {
+        'job': job_key.id(),
+        'name': job.name,
+        'params': job.params,
+        'started': job.started.isoformat(),
+        'shards': job.shards,
+        'shardsDone': sum(1 for state in states if state.done),
+        'processed': processed,
+        'written': sum(state.written for state in states),
+        'counters': counters,
+        'elapsedSeconds': round(elapsed, 1),
+        'entitiesPerSecond': round(processed / elapsed, 1),
+    }
+
+
+def recent_jobs(limit=20):
+    return MapperJob.query().order(-MapperJob.started).fetch(
+        limit, keys_only=True)
+
+
+# - - - mappers - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+class SeatReconciliationMapper(Mapper):
+    """SeatReconciliationMapper -- check each Conference's seatsAvailable
+    against the Profiles registered for it; with params fix=True, correct
+    the conferences that disagree.
+
+    Counts come from an eventually consistent query, so a registration in
+    flight can show up as a mismatch; run it with fix unset first. Fixes
+    are made in a transaction per conference rather than in the batched
+    put, which could overwrite a concurrent registration.
+    """
+    MODEL = Conference
+
+    def map(self, conf):
+        self.count('conferences')
+        wsck = conf.key.urlsafe()
+        registered = Profile.query(
+            Profile.conferenceKeysToAttend == wsck).count()
+        expected = (conf.maxAttendees or 0) - registered
+        if conf.seatsAvailable == expected:
+            return [], []
+
+        self.count('mismatched')
+        logging.warning('Conference %s: seatsAvailable %s, expected %d '
+                        '(%d registered)', wsck, conf.seatsAvailable,
+                        expected, registered)
+        if self.params.get('fix') and _fix_seats(conf.key,
+                                                 conf.seatsAvailable,
+                                                 expected):
+            self.count('fixed')
+        return [], []
+
+
+@ndb.transactional
+def _fix_seats(c_key, seen, expected):
+    conf = c_key.get()
+    # skip it if a registration changed the seats since we counted
+    if not conf or conf.seatsAvailable != seen:
+        return False
+    deltas = facets.deltas_for(conf, 'registrations',
+                               -facets.registered(conf))
+    conf.seatsAvailable = expected
+    conf.put()
+    deltas += facets.deltas_for(conf, 'registrations',
+                                facets.registered(conf))
+    facets.enqueue(deltas, transactional=True)
+    return True
+
+
+class FacetCountMapper(Mapper):
+    """FacetCountMapper -- add the conferences the facet counters don't
+    include yet, those created before there were counters. Each is
+    counted in a transaction that marks it, so running the job again
+    counts nothing twice.
+    """
+    MODEL = Conference
+
+    def map(self, conf):
+        self.count('conferences')
+        if not conf.facetsCounted and _count_facets(conf.key):
+            self.count('counted')
+        return [], []
+
+
+@ndb.transactional
+def _count_facets(c_key):
+    conf = c_key.get()
+    if not conf or conf.facetsCounted:
+        return False
+    conf.facetsCounted = True
+    conf.put()
+    facets.enqueue(facets.deltas_for(conf, 'conferences', 1) +
+                   facets.deltas_for(conf, 'registrations',
+                                     facets.registered(conf)),
+                   transactional=True)
+    return True
+
+
+class StampUpdatedMapper(Mapper):
+    """StampUpdatedMapper -- re-put the entities written before their
+    kind had an updated property, so auto_now stamps them and
+    getChangesSince reports them. Run it once per kind after deploying
+    the change feed; entities that have a stamp are left alone. Like seat
+    fixes, each re-put is its own transaction, so it can't overwrite a
+    concurrent registration or wishlist change.
+    """
+
+    def map(self, entity):
+        self.count('entities')
+        if entity.updated is None and _stamp(entity.key):
+            self.count('stamped')
+        return [], []
+
+
+@ndb.transactional
+def _stamp(key):
+    entity = key.get()
+    if not entity or entity.updated is not None:
+        return False
+    entity.put()
+    return True
+
+
+class StampConferencesMapper(StampUpdatedMapper):
+    MODEL = Conference
+
+
+class StampSessionsMapper(StampUpdatedMapper):
+    MODEL = Session
+
+
+class StampProfilesMapper(StampUpdatedMapper):
+    MODEL = Profile
+
+
+MAPPERS = {
+    'reconcile_seats': SeatReconciliationMapper,
+    'count_facets': FacetCountMapper,
+    'stamp_conferences': StampConferencesMapper,
+    'stamp_sessions': StampSessionsMapper,
+    'stamp_profiles': StampProfilesMapper,
+}
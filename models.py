@@ -17,19 +17,101 @@ import endpoints
 from protorpc import messages
 from google.appengine.ext import ndb
 
+from instrumentation import incr
+
 
 class ConflictException(endpoints.ServiceException):
     """ConflictException -- exception mapped to HTTP 409 response"""
     http_status = httplib.CONFLICT
 
 
-class Profile(ndb.Model):
+class TooManyRequestsException(endpoints.ServiceException):
+    """TooManyRequestsException -- exception mapped to HTTP 503 response;
+    the Endpoints proxy turns a 429 into 404, but passes 503 on as a
+    retryable error"""
+    http_status = httplib.SERVICE_UNAVAILABLE
+
+
+class TrackedModel(ndb.Model):
+    """TrackedModel -- remembers the property values an entity was read
+    or last written with, so put_if_changed() can skip no-op writes.
+
+    auto_now properties are not compared; they change on every put.
+    """
+
+    @classmethod
+    def _from_pb(cls, *args, **kwargs):
+        ent = super(TrackedModel, cls)._from_pb(*args, **kwargs)
+        # projection results are partial and never written back
+        if not ent._projection:
+            ent._mark_clean()
+        return ent
+
+    def _post_put_hook(self, future):
+        if not future.get_exception():
+            self._mark_clean()
+
+    def _tracked_values(self):
+        values = {}
+        for name, prop in self._properties.items():
+            if getattr(prop, '_auto_now', False):
+                continue
+            value = prop._get_value(self)
+            # other values are immutable; lists are copied so in place
+            # changes to repeated properties show up
+            values[name] = list(value) if isinstance(value, list) else value
+        return values
+
+    def _mark_clean(self):
+        self._saved_values = self._tracked_values()
+
+    def changed_properties(self):
+        """Return the names of properties changed since the entity was
+        read or written; all of them for a new entity."""
+        current = self._tracked_values()
+        saved = getattr(self, '_saved_values', None)
+        if saved is None:
+            return set(current)
+        return set(name for name, value in current.items()
+                   if saved.get(name) != value)
+
+    def _count_put(self, changed):
+        kind = self._get_kind()
+        if not changed:
+            incr('datastore.%s.put.skipped' % kind)
+            return False
+        incr('datastore.%s.put' % kind)
+        # indexed auto_now properties get new index rows on every put
+        rewritten = set(changed) | set(
+            name for name, prop in self._properties.items()
+            if getattr(prop, '_auto_now', False))
+        if not any(self._properties[name]._indexed for name in rewritten):
+            incr('datastore.%s.put.unindexed' % kind)
+        return True
+
+    def put_if_changed(self):
+        """put() the entity unless nothing changed; return its key."""
+        if self._count_put(self.changed_properties()):
+            return self.put()
+        return self.key
+
+
+def put_multi_if_changed(entities):
+    """ndb.put_multi() the TrackedModel entities that changed."""
+    changed = [ent for ent in entities
+               if ent._count_put(ent.changed_properties())]
+    return ndb.put_multi(changed)
+
+
+class Profile(TrackedModel):
     """Profile -- User profile object"""
-    displayName = ndb.StringProperty()
+    # only conferenceKeysToAttend is ever queried
+    displayName = ndb.StringProperty(indexed=False)
     mainEmail = ndb.StringProperty()
-    teeShirtSize = ndb.StringProperty(default='NOT_SPECIFIED')
+    teeShirtSize = ndb.StringProperty(default='NOT_SPECIFIED', indexed=False)
     conferenceKeysToAttend = ndb.StringProperty(repeated=True)
-    sessionKeysWishList = ndb.StringProperty(repeated=True)
+    sessionKeysWishList = ndb.StringProperty(repeated=True, indexed=False)
+    updated = ndb.DateTimeProperty(auto_now=True, indexed=False)
 
 
 class ProfileMiniForm(messages.Message):
@@ -52,10 +134,10 @@ class BooleanMessage(messages.Message):
     data = messages.BooleanField(1)
 
 
-class Conference(ndb.Model):
+class Conference(TrackedModel):
     """Conference -- Conference object"""
     name = ndb.StringProperty(required=True)
-    description = ndb.StringProperty()
+    description = ndb.StringProperty(indexed=False)
     organizerUserId = ndb.StringProperty()
     topics = ndb.StringProperty(repeated=True)
     city = ndb.StringProperty()
@@ -64,6 +146,63 @@ class Conference(ndb.Model):
     endDate = ndb.DateProperty()
     maxAttendees = ndb.IntegerProperty()
     seatsAvailable = ndb.IntegerProperty()
+    # set once the facet counters include this conference; older ones
+    # are added by the count_facets mapper
+    facetsCounted = ndb.BooleanProperty(default=False, indexed=False)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+
+class WaitlistEntry(ndb.Model):
+    """WaitlistEntry -- user waiting for a seat in a sold out conference.
+
+    Keyed by websafeConferenceKey and user ID, outside the conference's
+    entity group, so joining is a single blind put that doesn't contend
+    with registrations.
+    """
+    websafeConferenceKey = ndb.StringProperty()
+    userId = ndb.StringProperty(indexed=False)
+    joined = ndb.DateTimeProperty(auto_now_add=True)
+
+    @classmethod
+    def key_for(cls, wsck, user_id):
+        return ndb.Key(cls, '%s|%s' % (wsck, user_id))
+
+
+class FacetCounterShard(ndb.Model):
+    """FacetCounterShard -- one shard of a conference facet counter"""
+    metric = ndb.StringProperty(indexed=False)
+    dimension = ndb.StringProperty(indexed=False)
+    value = ndb.StringProperty(indexed=False)
+    count = ndb.IntegerProperty(default=0, indexed=False)
+
+
+class FacetTaskMarker(ndb.Model):
+    """FacetTaskMarker -- records that one chunk of an update_facets
+    task's deltas was applied, keyed by task name and chunk, so a retried
+    task doesn't count it twice."""
+    applied = ndb.DateTimeProperty(auto_now_add=True)
+
+
+class MapperJob(ndb.Model):
+    """MapperJob -- one run of a mapper.py job; its MapperShard
+    children hold the progress."""
+    name = ndb.StringProperty()
+    params = ndb.JsonProperty()
+    shards = ndb.IntegerProperty(indexed=False)
+    started = ndb.DateTimeProperty(auto_now_add=True)
+
+
+class MapperShard(ndb.Model):
+    """MapperShard -- checkpoint of one key range of a MapperJob"""
+    startKey = ndb.KeyProperty(indexed=False)
+    endKey = ndb.KeyProperty(indexed=False)
+    cursor = ndb.StringProperty(indexed=False)
+    slices = ndb.IntegerProperty(default=0, indexed=False)
+    processed = ndb.IntegerProperty(default=0, indexed=False)
+    written = ndb.IntegerProperty(default=0, indexed=False)
+    counters = ndb.JsonProperty()
+    done = ndb.BooleanProperty(default=False, indexed=False)
+    updated = ndb.DateTimeProperty(auto_now=True, indexed=False)
 
 
 class ConferenceForm(messages.Message):
@@ -85,17 +224,51 @@ class ConferenceForm(messages.Message):
 class ConferenceForms(messages.Message):
     """ConferenceForms -- multiple Conference outbound form message"""
     items = messages.MessageField(ConferenceForm, 1, repeated=True)
+    compressedItems = messages.BytesField(2)
+    websafeCursor = messages.StringField(3)
 
 
-class Session(ndb.Model):
+class Session(TrackedModel):
     """Session -- Session object"""
     name = ndb.StringProperty(required=True)
-    highlights = ndb.StringProperty(repeated=True)
+    highlights = ndb.StringProperty(repeated=True, indexed=False)
     speaker = ndb.StringProperty()
     typeOfSession = ndb.StringProperty()
     date = ndb.DateProperty()
     startTime = ndb.TimeProperty()
-    duration = ndb.FloatProperty()
+    duration = ndb.FloatProperty(indexed=False)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+
+class Tombstone(ndb.Model):
+    """Tombstone -- websafe keys of entities deleted together, kept for a
+    while so getChangesSince can report the deletions."""
+    websafeKeys = ndb.StringProperty(repeated=True, indexed=False)
+    deleted = ndb.DateTimeProperty(auto_now_add=True)
+
+
+class ArchivedSessions(ndb.Model):
+    """ArchivedSessions -- the sessions of an archived conference, packed
+    into one unindexed entity keyed under the archived Conference."""
+    sessions = ndb.JsonProperty(compressed=True)
+
+    @classmethod
+    def key_for(cls, c_key):
+        return ndb.Key(cls, 1, parent=c_key)
+
+
+class SessionRecommendations(ndb.Model):
+    """SessionRecommendations -- sessions most often wishlisted together
+    with one session, keyed by its websafeSessionKey; computed offline."""
+    websafeSessionKeys = ndb.StringProperty(repeated=True, indexed=False)
+    counts = ndb.IntegerProperty(repeated=True, indexed=False)
+    computed = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+
+class FeaturedSpeaker(ndb.Model):
+    """FeaturedSpeaker -- last featured speaker, used to rebuild the cache"""
+    speaker = ndb.StringProperty()
+    websafeConferenceKey = ndb.StringProperty(indexed=False)
 
 
 class SessionForm(messages.Message):
@@ -114,6 +287,63 @@ class SessionForm(messages.Message):
 class SessionForms(messages.Message):
     """SessionForms -- multiple Session outbound form message"""
     items = messages.MessageField(SessionForm, 1, repeated=True)
+    compressedItems = messages.BytesField(2)
+    websafeCursor = messages.StringField(3)
+
+
+class WebsafeKeysForm(messages.Message):
+    """WebsafeKeysForm -- inbound list of websafe entity keys"""
+    websafeKeys = messages.StringField(1, repeated=True)
+
+
+class ConferenceResultForm(messages.Message):
+    """ConferenceResultForm -- one looked up conference, or why not"""
+    websafeKey = messages.StringField(1)
+    conference = messages.MessageField(ConferenceForm, 2)
+    notFound = messages.BooleanField(3)
+    error = messages.StringField(4)
+
+
+class ConferenceResultForms(messages.Message):
+    """ConferenceResultForms -- one ConferenceResultForm per requested key"""
+    items = messages.MessageField(ConferenceResultForm, 1, repeated=True)
+
+
+class SessionResultForm(messages.Message):
+    """SessionResultForm -- one looked up session, or why not"""
+    websafeKey = messages.StringField(1)
+    session = messages.MessageField(SessionForm, 2)
+    notFound = messages.BooleanField(3)
+    error = messages.StringField(4)
+
+
+class SessionResultForms(messages.Message):
+    """SessionResultForms -- one SessionResultForm per requested key"""
+    items = messages.MessageField(SessionResultForm, 1, repeated=True)
+
+
+class ConferenceDetailForm(messages.Message):
+    """ConferenceDetailForm -- Conference detail page outbound form message"""
+    conference = messages.MessageField(ConferenceForm, 1)
+    sessions = messages.MessageField(SessionForm, 2, repeated=True)
+    isUserAttending = messages.BooleanField(3)
+    sessionKeysWishList = messages.StringField(4, repeated=True)
+
+
+class FacetCountForm(messages.Message):
+    """FacetCountForm -- counts for one facet value outbound form message"""
+    value = messages.StringField(1)
+    conferences = messages.IntegerField(2)
+    registrations = messages.IntegerField(3)
+
+
+class ConferenceFacetsForm(messages.Message):
+    """ConferenceFacetsForm -- conference facet counts outbound form message"""
+    cities = messages.MessageField(FacetCountForm, 1, repeated=True)
+    topics = messages.MessageField(FacetCountForm, 2, repeated=True)
+    months = messages.MessageField(FacetCountForm, 3, repeated=True)
+    totalConferences = messages.IntegerField(4)
+    totalRegistrations = messages.IntegerField(5)
 
 
 class TeeShirtSize(messages.Enum):
@@ -145,6 +375,26 @@ class ConferenceQueryForm(messages.Message):
 class ConferenceQueryForms(messages.Message):
     """ConferenceQueryForms -- multiple ConferenceQueryForm inbound form message"""
     filters = messages.MessageField(ConferenceQueryForm, 1, repeated=True)
+    fieldMask = messages.StringField(2)
+    compressed = messages.BooleanField(3)
+    archived = messages.BooleanField(4)
+    websafeCursor = messages.StringField(5)
+
+
+class ChangeForm(messages.Message):
+    """ChangeForm -- key of an entity changed or deleted since a watermark"""
+    kind = messages.StringField(1)
+    websafeKey = messages.StringField(2)
+    updated = messages.StringField(3)
+
+
+class ChangesForm(messages.Message):
+    """ChangesForm -- one page of the getChangesSince feed"""
+    changed = messages.MessageField(ChangeForm, 1, repeated=True)
+    deleted = messages.MessageField(ChangeForm, 2, repeated=True)
+    watermark = messages.StringField(3)
+    websafeCursor = messages.StringField(4)
+    fullResync = messages.BooleanField(5)
 
 
 class StringMessage(messages.Message):
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+"""ratelimit.py
+
+Udacity conference server-side Python App Engine admission control;
+    token buckets shared through memcache, with an in-instance fast path
+
+Each instance takes tokens from the shared bucket a few at a time
+(lease) and spends them locally, and remembers an empty bucket until it
+should have refilled, so most calls never touch memcache.
+
+$Id$
+
+"""
+
+import functools
+import os
+import threading
+import time
+
+import endpoints
+from google.appengine.api import memcache
+
+from instrumentation import incr
+from models import TooManyRequestsException
+from utils import get_user_id
+
+CAS_RETRIES = 5
+MAX_LOCAL_KEYS = 10000
+
+
+class TokenBucket(object):
+    """TokenBucket -- rate tokens per second per key, up to burst"""
+
+    def __init__(self, name, rate, burst, lease=1):
+        self.name = name
+        self.rate = float(rate)
+        self.burst = burst
+        self.lease = lease
+        self._lock = threading.Lock()
+        # key -> [leased tokens, denied until]
+        self._local = {}
+
+    def allow(self, key):
+        """Take one token for key; return False if the bucket is empty."""
+        now = time.time()
+        with self._lock:
+            local = self._local.get(key)
+            if local is None:
+                if len(self._local) >= MAX_LOCAL_KEYS:
+                    self._local.clear()
+                local = self._local[key] = [0, 0]
+            if local[1] > now:
+                incr('ratelimit.%s.denied.local' % self.name)
+                return False
+            if local[0] > 0:
+                local[0] -= 1
+                incr('ratelimit.%s.allowed.local' % self.name)
+                return True
+
+        granted = self._take(key, self.lease)
+        with self._lock:
+            if not granted:
+                # don't ask memcache again before one token has refilled
+                local[1] = now + 1 / self.rate
+                incr('ratelimit.%s.denied' % self.name)
+                return False
+            local[0] += granted - 1
+            incr('ratelimit.%s.allowed' % self.name)
+            return True
+
+    def _take(self, key, wanted):
+        """Take up to wanted tokens from the shared bucket in memcache."""
+        client = memcache.Client()
+        m_key = 'RATELIMIT:%s:%s' % (self.name, key)
+        # an idle bucket is full again after burst / rate seconds
+        ttl = int(self.burst / self.rate) + 1
+        for _ in range(CAS_RETRIES):
+            now = time.time()
+            state = client.gets(m_key)
+            if state is None:
+                tokens = self.burst
+            else:
+                tokens, stamp = state
+                tokens = min(self.burst, tokens + (now - stamp) * self.rate)
+            granted = min(wanted, int(tokens))
+            new_state = (tokens - granted, now)
+            if state is None:
+                stored = client.add(m_key, new_state, time=ttl)
+            else:
+                stored = client.cas(m_key, new_state, time=ttl)
+            if stored:
+                return granted
+        # memcache too contended or unavailable: fail open rather than
+        # turning a cache problem into an outage
+        incr('ratelimit.%s.failopen' % self.name)
+        return 1
+
+
+# per caller across all API methods, and per conference for registrations
+user_bucket = TokenBucket('user', rate=10, burst=30, lease=5)
+conference_bucket = TokenBucket('conference', rate=20, burst=50, lease=1)
+
+
+def _caller_key():
+    user = endpoints.get_current_user()
+    if user:
+        return get_user_id(user)
+    return 'anonymous:%s' % os.environ.get('REMOTE_ADDR', '')
+
+
+def throttled(func):
+    """Reject the call with 503 if the caller is over their rate."""
+    @functools.wraps(func)
+    def wrapper(self, request):
+        if not user_bucket.allow(_caller_key()):
+            raise TooManyRequestsException(
+                'Too many requests, please retry later.')
+        return func(self, request)
+    return wrapper
+
+
+def admit_registration(wsck):
+    """Reject the call with 503 if the conference is over its
+    registration rate."""
+    if not conference_bucket.allow(wsck):
+        raise TooManyRequestsException(
+            'Too many registrations for this conference, please retry later.')
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+"""recommendations.py
+
+Udacity conference server-side Python App Engine session recommendations;
+    offline job that counts how often sessions are wishlisted together
+    and stores the top neighbours of each session
+
+The co-occurrence matrix is kept sparse as (row, column) index pairs,
+counted with numpy. Only the job imports this module, so numpy stays out
+of instance start up.
+
+$Id$
+
+"""
+
+import numpy as np
+from google.appengine.ext import ndb
+
+from models import Profile
+from models import SessionRecommendations
+
+TOP_N = 10
+# a handful of huge wishlists would otherwise dominate the pair count
+MAX_WISHLIST = 100
+PROFILE_BATCH_SIZE = 500
+PUT_BATCH_SIZE = 500
+# pairs collected before they are reduced to (cell, count) and merged
+# into the running totals, bounding memory to a few multiples of this
+PAIR_BATCH_SIZE = 1000000
+
+
+def read_wishlists():
+    """Return the session keys and, per profile with two or more wishlisted
+    sessions, an int32 array of their indexes into that list."""
+    codes = {}
+    wssks = []
+    wishlists = []
+    for prof in Profile.query().iter(batch_size=PROFILE_BATCH_SIZE):
+        wishlist = list(set(prof.sessionKeysWishList))[:MAX_WISHLIST]
+        if len(wishlist) < 2:
+            continue
+        indexes = []
+        for wssk in wishlist:
+            code = codes.get(wssk)
+            if code is None:
+                code = codes[wssk] = len(wssks)
+                wssks.append(wssk)
+            indexes.append(code)
+        wishlists.append(np.array(indexes, np.int32))
+    return wssks, wishlists
+
+
+def _count_cells(cells, weights=None):
+    """Return the distinct cells and how often (or, with weights, how
+    much in total) each occurs."""
+    # np.unique has no return_counts before numpy 1.9
+    distinct, inverse = np.unique(cells, return_inverse=True)
+    counts = np.bincount(inverse, weights)
+    return distinct, counts.astype(np.int64)
+
+
+def co_occurrence(n, wishlists):
+    """Return (rows, cols, counts) of the sparse n x n matrix counting the
+    wishlists each ordered pair of distinct sessions appears in. Pairs
+    are reduced batch by batch, so only the distinct cells are kept."""
+    cells = np.zeros(0, np.int64)
+    counts = np.zeros(0, np.int64)
+    pairs = []
+    pending = 0
+    for i, indexes in enumerate(wishlists):
+        k = len(indexes)
+        rows = np.repeat(indexes, k).astype(np.int64)
+        cols = np.tile(indexes, k).astype(np.int64)
+        keep = rows != cols
+        pairs.append(rows[keep] * n + cols[keep])
+        pending += k * (k - 1)
+        if pending >= PAIR_BATCH_SIZE or i == len(wishlists) - 1:
+            batch_cells, batch_counts = _count_cells(np.concatenate(pairs))
+            pairs, pending = [], 0
+            cells, counts = _count_cells(
+                np.concatenate([cells, batch_cells]),
+                np.concatenate([counts, batch_counts]))
+    return cells // n, cells % n, counts
+
+
+def top_neighbours(rows, cols, counts, top_n=TOP_N):
+    """Yield (row, cols, counts) with each row's top_n columns, highest
+    count first."""
+    if not len(rows):
+        return
+    # by row, then by descending count, then by column for stable ties
+    order = np.lexsort((cols, -counts, rows))
+    rows, cols, counts = rows[order], cols[order], counts[order]
+    starts = np.concatenate([[0], np.nonzero(np.diff(rows))[0] + 1])
+    ends = np.concatenate([starts[1:], [len(rows)]])
+    for start, end in zip(starts, ends):
+        end = min(end, start + top_n)
+        yield int(rows[start]), cols[start:end], counts[start:end]
+
+
+def compute(top_n=TOP_N):
+    """Recompute SessionRecommendations for every wishlisted session and
+    delete those of sessions no longer wishlisted with any other."""
+    wssks, wishlists = read_wishlists()
+    rows, cols, counts = co_occurrence(len(wssks), wishlists)
+
+    written = set()
+    batch = []
+    for row, neighbours, neighbour_counts in top_neighbours(
+            rows, cols, counts, top_n):
+        batch.append(SessionRecommendations(
+            id=wssks[row],
+            websafeSessionKeys=[wssks[col] for col in neighbours],
+            counts=[int(count) for count in neighbour_counts]))
+        written.add(wssks[row])
+        if len(batch) == PUT_BATCH_SIZE:
+            ndb.put_multi(batch)
+            batch = []
+    ndb.put_multi(batch)
+
+    stale = [key for key in SessionRecommendations.query().iter(
+        keys_only=True) if key.id() not in written]
+    ndb.delete_multi(stale)
+    return len(written)
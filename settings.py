@@ -16,3 +16,11 @@ WEB_CLIENT_ID = '116967032439-djp72l3avcs61qhenllcr9iaa0jcbb2u.apps.googleuserco
 ANDROID_CLIENT_ID = 'replace with Android client ID'
 IOS_CLIENT_ID = 'replace with iOS client ID'
 ANDROID_AUDIENCE = WEB_CLIENT_ID
+
+# Log a TRACE line for every API call so production traffic can be
+# replayed locally with tools/loadgen.py.
+TRACE_API_CALLS = False
+
+# Serve queryConferences from an in-instance columnar snapshot of the
+# conference catalog (catalog.py) instead of Datastore queries.
+CATALOG_SNAPSHOT = False
@@ -249,7 +249,7 @@ conferenceApp.controllers.controller('CreateConferenceCtrl',
  * @description
  * A controller used for the Show conferences page.
  */
-conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $log, oauth2Provider, HTTP_ERRORS) {
+conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $log, $http, oauth2Provider, HTTP_ERRORS) {
 
     /**
      * Holds the status if the query is being executed.
@@ -293,6 +293,14 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
      */
     $scope.conferences = [];
 
+    /**
+     * Holds the cursor to continue the last query from, if it returned
+     * only part of the result, and the filters it was run with.
+     * @type {string}
+     */
+    $scope.websafeCursor = null;
+    $scope.lastQuery = null;
+
     /**
      * Holds the state if offcanvas is enabled.
      *
@@ -424,22 +432,34 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
     };
 
     /**
-     * Invokes the conference.queryConferences API.
+     * Invokes the conference.queryConferences API. With loadMore, continues
+     * the last query from its cursor and appends the results.
      */
-    $scope.queryConferencesAll = function () {
+    $scope.queryConferencesAll = function (loadMore) {
         var sendFilters = {
             filters: []
         };
-        for (var i = 0; i < $scope.filters.length; i++) {
-            var filter = $scope.filters[i];
-            if (filter.field && filter.operator && filter.value) {
-                sendFilters.filters.push({
-                    field: filter.field.enumValue,
-                    operator: filter.operator.enumValue,
-                    value: filter.value
-                });
+        if (loadMore) {
+            sendFilters.filters = $scope.lastQuery.filters;
+            sendFilters.websafeCursor = $scope.websafeCursor;
+        } else {
+            for (var i = 0; i < $scope.filters.length; i++) {
+                var filter = $scope.filters[i];
+                if (filter.field && filter.operator && filter.value) {
+                    sendFilters.filters.push({
+                        field: filter.field.enumValue,
+                        operator: filter.operator.enumValue,
+                        value: filter.value
+                    });
+                }
+            }
+            $scope.websafeCursor = null;
+            if (sendFilters.filters.length == 0) {
+                $scope.getPublicConferences();
+                return;
             }
         }
+        $scope.lastQuery = {filters: sendFilters.filters};
         $scope.loading = true;
         gapi.client.conference.queryConferences(sendFilters).
             execute(function (resp) {
@@ -458,16 +478,58 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
                         $scope.alertStatus = 'success';
                         $log.info($scope.messages);
 
-                        $scope.conferences = [];
+                        if (!loadMore) {
+                            $scope.conferences = [];
+                        }
                         angular.forEach(resp.items, function (conference) {
                             $scope.conferences.push(conference);
                         });
+                        $scope.websafeCursor = resp.websafeCursor || null;
                     }
                     $scope.submitted = true;
                 });
             });
     };
 
+    /**
+     * Fetches the rest of a query that returned only part of its result.
+     */
+    $scope.loadMoreConferences = function () {
+        $scope.queryConferencesAll(true);
+    };
+
+    /**
+     * Fetches the unfiltered list from the public, edge cached listing
+     * instead of running a query through the API.
+     */
+    $scope.getPublicConferences = function () {
+        $scope.loading = true;
+        $http.get('/public/conferences').
+            success(function (data) {
+                $scope.loading = false;
+                $scope.messages = 'Query succeeded';
+                $scope.alertStatus = 'success';
+                $log.info($scope.messages);
+
+                $scope.conferences = [];
+                angular.forEach(data.items, function (conference) {
+                    $scope.conferences.push(conference);
+                });
+                // a long listing is cut short; queryConferences without
+                // filters continues it
+                $scope.websafeCursor = data.websafeCursor || null;
+                $scope.lastQuery = {filters: []};
+                $scope.submitted = true;
+            }).
+            error(function (data, status) {
+                $scope.loading = false;
+                $scope.messages = 'Failed to query conferences : ' + status;
+                $scope.alertStatus = 'warning';
+                $log.error($scope.messages);
+                $scope.submitted = true;
+            });
+    };
+
     /**
      * Invokes the conference.getConferencesCreated method.
      */
@@ -552,14 +614,27 @@ conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $
 
     $scope.isUserAttending = false;
 
+    /**
+     * Holds the sessions of the conference.
+     * @type {Array}
+     */
+    $scope.sessions = [];
+
+    /**
+     * Holds the websafe keys of the sessions in the user's wish list.
+     * @type {Array}
+     */
+    $scope.sessionKeysWishList = [];
+
     /**
      * Initializes the conference detail page.
-     * Invokes the conference.getConference method and sets the returned conference in the $scope.
+     * Invokes the conference.getConferenceDetail method, which returns the conference, its sessions and
+     * the user's registration status in a single round trip, and sets them in the $scope.
      *
      */
     $scope.init = function () {
         $scope.loading = true;
-        gapi.client.conference.getConference({
+        gapi.client.conference.getConferenceDetail({
             websafeConferenceKey: $routeParams.websafeConferenceKey
         }).execute(function (resp) {
             $scope.$apply(function () {
@@ -574,33 +649,30 @@ conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $
                 } else {
                     // The request has succeeded.
                     $scope.alertStatus = 'success';
-                    $scope.conference = resp.result;
-                }
-            });
-        });
-
-        $scope.loading = true;
-        // If the user is attending the conference, updates the status message and available function.
-        gapi.client.conference.getProfile().execute(function (resp) {
-            $scope.$apply(function () {
-                $scope.loading = false;
-                if (resp.error) {
-                    // Failed to get a user profile.
-                } else {
-                    var profile = resp.result;
-                    for (var i = 0; i < profile.conferenceKeysToAttend.length; i++) {
-                        if ($routeParams.websafeConferenceKey == profile.conferenceKeysToAttend[i]) {
-                            // The user is attending the conference.
-                            $scope.alertStatus = 'info';
-                            $scope.messages = 'You are attending this conference';
-                            $scope.isUserAttending = true;
-                        }
+                    $scope.conference = resp.result.conference;
+                    $scope.sessions = resp.result.sessions || [];
+                    $scope.sessionKeysWishList = resp.result.sessionKeysWishList || [];
+                    if (resp.result.isUserAttending) {
+                        // The user is attending the conference.
+                        $scope.alertStatus = 'info';
+                        $scope.messages = 'You are attending this conference';
+                        $scope.isUserAttending = true;
                     }
                 }
             });
         });
     };
 
+    /**
+     * Returns true if the session is in the user's wish list.
+     *
+     * @param session
+     * @returns {boolean}
+     */
+    $scope.isInWishList = function (session) {
+        return $scope.sessionKeysWishList.indexOf(session.websafeSessionKey) >= 0;
+    };
+
 
     /**
      * Invokes the conference.registerForConference method.
@@ -639,6 +711,32 @@ conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $
         });
     };
 
+    /**
+     * Invokes the conference.joinWaitlist method.
+     */
+    $scope.joinWaitlist = function () {
+        $scope.loading = true;
+        gapi.client.conference.joinWaitlist({
+            websafeConferenceKey: $routeParams.websafeConferenceKey
+        }).execute(function (resp) {
+            $scope.$apply(function () {
+                $scope.loading = false;
+                if (resp.error) {
+                    // The request has failed.
+                    var errorMessage = resp.error.message || '';
+                    $scope.messages = 'Failed to join the waitlist : ' + errorMessage;
+                    $scope.alertStatus = 'warning';
+                    $log.error($scope.messages);
+                } else {
+                    // Joined the waitlist.
+                    $scope.messages = 'You are on the waitlist. You will be registered when a seat frees up';
+                    $scope.alertStatus = 'info';
+                    $scope.isUserWaitlisted = true;
+                }
+            });
+        });
+    };
+
     /**
      * Invokes the conference.unregisterForConference method.
      */
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+
+"""build_assets.py
+
+Bundle, minify and fingerprint the web client's local CSS and JS, inline
+    the Angular partials into $templateCache, and regenerate the app.yaml
+    handlers that serve the result with far-future expiration
+
+templates/index.html is the source page. Its local stylesheets and
+scripts sit between <!-- build:css --> / <!-- build:js --> and
+<!-- endbuild --> comments; each block becomes one file named after a hash
+of its content, under static/build/, and static/build/index.html refers
+to those. The partials are appended to the JS bundle, so route changes
+don't fetch templates. The app.yaml handlers between the generated
+markers serve /, and /assets/ with a one year expiry, which is safe
+because a changed file gets a new name.
+
+The files of the previous build are kept, so pages cached before a
+deploy can still load their bundles.
+
+    python tools/build_assets.py            # build and update app.yaml
+    python tools/build_assets.py --check    # report only, write nothing
+
+rjsmin and rcssmin are used if installed; otherwise a conservative
+built-in minifier strips comments and indentation only.
+
+$Id$
+
+"""
+
+import argparse
+import glob
+import hashlib
+import io
+import json
+import os
+import re
+import sys
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SOURCE_PAGE = os.path.join(APP_DIR, 'templates', 'index.html')
+PARTIALS_DIR = os.path.join(APP_DIR, 'static', 'partials')
+BUILD_DIR = os.path.join(APP_DIR, 'static', 'build')
+MANIFEST = os.path.join(BUILD_DIR, 'manifest.json')
+APP_YAML = os.path.join(APP_DIR, 'app.yaml')
+
+# URL prefixes of local assets, as served by app.yaml, and their sources
+URL_DIRS = {
+    '/css/': os.path.join('static', 'bootstrap', 'css'),
+    '/js/': os.path.join('static', 'js'),
+}
+ASSETS_URL = '/assets/'
+ANGULAR_MODULE = 'conferenceApp'
+HASH_LENGTH = 10
+
+BLOCK_RE = re.compile(
+    r'([ \t]*)<!-- build:(css|js) -->.*?<!-- endbuild -->', re.S)
+HREF_RE = re.compile(r'(?:href|src)="([^"]+)"')
+
+APP_YAML_BEGIN = '# - - - generated by tools/build_assets.py - - -'
+APP_YAML_END = '# - - - end of generated handlers - - -'
+APP_YAML_HANDLERS = """\
+- url: /
+  static_files: static/build/index.html
+  upload: static/build/index\\.html
+  secure: always
+  expiration: "1m"
+
+- url: %(assets)s(.+\\.(css|js))
+  static_files: static/build/\\1
+  upload: static/build/.+\\.(css|js)
+  expiration: "365d"
+"""
+
+try:
+    import rcssmin
+except ImportError:
+    rcssmin = None
+
+try:
+    import rjsmin
+except ImportError:
+    rjsmin = None
+
+
+# - - - minification - - - - - - - - - - - - - - - - - - - - - - -
+
+def minify_css(css):
+    if rcssmin:
+        return rcssmin.cssmin(css)
+    # drop comments except /*! license */ ones, then collapse whitespace
+    css = re.sub(r'/\*(?!!).*?\*/', '', css, flags=re.S)
+    css = re.sub(r'\s+', ' ', css)
+    css = re.sub(r'\s*([{};,>])\s*', r'\1', css)
+    css = re.sub(r';}', '}', css)
+    return css.strip() + '\n'
+
+
+def minify_js(js):
+    if rjsmin:
+        return rjsmin.jsmin(js)
+    # line based, so automatic semicolon insertion is unaffected: drop
+    # whole-line and block comments that start a line, and indentation
+    out = []
+    in_comment = False
+    for line in js.splitlines():
+        text = line.strip()
+        if in_comment:
+            in_comment = '*/' not in text
+            continue
+        if text.startswith('/*') and not text.startswith('/*!'):
+            if '*/' not in text:
+                in_comment = True
+            elif text.split('*/', 1)[1].strip():
+                out.append(text.split('*/', 1)[1].strip())
+            continue
+        if not text or text.startswith('//'):
+            continue
+        out.append(text)
+    return '\n'.join(out) + '\n'
+
+
+# - - - bundles - - - - - - - - - - - - - - - - - - - - - - - - -
+
+def source_path(url):
+    for prefix, directory in URL_DIRS.items():
+        if url.startswith(prefix):
+            return os.path.join(APP_DIR, directory, url[len(prefix):])
+    raise ValueError('%s is not a local asset' % url)
+
+
+def read(path):
+    with io.open(path, encoding='utf-8') as f:
+        return f.read()
+
+
+def template_cache_js():
+    """Return JS that puts every partial into $templateCache under the
+    URL the routes load it from."""
+    puts = []
+    for path in sorted(glob.glob(os.path.join(PARTIALS_DIR, '*.html'))):
+        url = '/partials/%s' % os.path.basename(path)
+        puts.append('    $templateCache.put(%s, %s);'
+                    % (json.dumps(url), json.dumps(read(path))))
+    return ("angular.module('%s').run(['$templateCache', "
+            "function ($templateCache) {\n%s\n}]);\n"
+            % (ANGULAR_MODULE, '\n'.join(puts)))
+
+
+def build_bundle(kind, urls):
+    """Return (file name, content) of the minified bundle of urls."""
+    sources = [read(source_path(url)) for url in urls]
+    if kind == 'css':
+        content = ''.join(minify_css(source) for source in sources)
+    else:
+        sources.append(template_cache_js())
+        # a statement ending without a semicolon must not run into the
+        # next file
+        content = ';\n'.join(minify_js(source) for source in sources)
+    digest = hashlib.md5(content.encode('utf-8')).hexdigest()[:HASH_LENGTH]
+    return 'app.%s.%s' % (digest, kind), content
+
+
+def tag(kind, name):
+    if kind == 'css':
+        return '<link rel="stylesheet" href="%s%s">' % (ASSETS_URL, name)
+    return '<script src="%s%s"></script>' % (ASSETS_URL, name)
+
+
+def build_page(page):
+    """Return the built page and {file name: content} of its bundles."""
+    bundles = {}
+
+    def replace(match):
+        indent, kind = match.group(1), match.group(2)
+        name, content = build_bundle(kind, HREF_RE.findall(match.group(0)))
+        bundles[name] = content
+        return indent + tag(kind, name)
+
+    return BLOCK_RE.sub(replace, page), bundles
+
+
+# - - - output - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+def write(path, content):
+    if isinstance(content, bytes):
+        content = content.decode('utf-8')
+    with io.open(path, 'w', encoding='utf-8', newline='\n') as f:
+        f.write(content)
+
+
+def write_build(page, bundles):
+    """Write the page and bundles, deleting all but the previous build."""
+    if not os.path.isdir(BUILD_DIR):
+        os.makedirs(BUILD_DIR)
+    keep = set(bundles)
+    if os.path.exists(MANIFEST):
+        keep.update(json.loads(read(MANIFEST))['files'])
+    for path in glob.glob(os.path.join(BUILD_DIR, 'app.*')):
+        if os.path.basename(path) not in keep:
+            os.remove(path)
+    for name, content in bundles.items():
+        write(os.path.join(BUILD_DIR, name), content)
+    write(os.path.join(BUILD_DIR, 'index.html'), page)
+    write(MANIFEST, json.dumps({'files': sorted(bundles)}, indent=2,
+                               separators=(',', ': ')) + '\n')
+
+
+def update_app_yaml(path=APP_YAML):
+    text = read(path)
+    begin, end = text.find(APP_YAML_BEGIN), text.find(APP_YAML_END)
+    if begin < 0 or end < 0:
+        raise ValueError('generated handler markers not found in %s' % path)
+    handlers = APP_YAML_HANDLERS % {'assets': ASSETS_URL}
+    write(path, '%s%s\n\n%s\n%s' % (text[:begin], APP_YAML_BEGIN, handlers,
+                                    text[end:]))
+
+
+def report(page_urls, bundles, out=sys.stdout):
+    before = sum(os.path.getsize(source_path(url)) for url in page_urls)
+    before += sum(os.path.getsize(path) for path in
+                  glob.glob(os.path.join(PARTIALS_DIR, '*.html')))
+    partials = len(glob.glob(os.path.join(PARTIALS_DIR, '*.html')))
+    after = sum(len(content) for content in bundles.values())
+    out.write('local requests: %d css/js + %d partials -> %d bundles\n'
+              % (len(page_urls), partials, len(bundles)))
+    out.write('bytes: %d -> %d\n' % (before, after))
+    for name in sorted(bundles):
+        out.write('  %s%s  %d bytes\n' % (ASSETS_URL, name,
+                                          len(bundles[name])))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[2])
+    parser.add_argument('--check', action='store_true',
+                        help='report what would be built, write nothing')
+    args = parser.parse_args(argv)
+
+    source = read(SOURCE_PAGE)
+    page_urls = [url for block in BLOCK_RE.finditer(source)
+                 for url in HREF_RE.findall(block.group(0))]
+    page, bundles = build_page(source)
+    report(page_urls, bundles)
+    if not args.check:
+        write_build(page, bundles)
+        update_app_yaml()
+        sys.stdout.write('wrote %s and %s\n' % (BUILD_DIR, APP_YAML))
+
+
+if __name__ == '__main__':
+    main()
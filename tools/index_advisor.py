@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+
+"""index_advisor.py
+
+Propose a minimal set of Conference composite indexes for the queries
+    queryConferences can build, and estimate the index writes each set
+    costs per Conference.put()
+
+_get_query() / _format_filters() in conference.py allow equality filters
+on any of the FIELDS, at most one inequality field, and always sort by
+name (after the inequality field, if any). Instead of one index per
+combination of filters, Datastore can answer a query by a zigzag merge
+join of several indexes that share the same suffix of sort properties:
+one (field, name) index per equality field, and (field, inequality,
+name) per equality field and inequality field, cover every shape.
+
+    python tools/index_advisor.py               # report only
+    python tools/index_advisor.py --write       # rewrite index.yaml
+    python tools/index_advisor.py --exact       # one index per shape
+
+$Id$
+
+"""
+
+import argparse
+import ast
+import itertools
+import os
+import sys
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+KIND = 'Conference'
+SORT = 'name'
+REPEATED = ('topics',)
+
+# Conference properties that are indexed (every ndb property not marked
+# indexed=False), used to count built-in index writes
+INDEXED_PROPERTIES = ('name', 'organizerUserId', 'topics', 'city',
+                      'startDate', 'month', 'endDate', 'maxAttendees',
+                      'seatsAvailable', 'updated')
+
+# write costs, in index rows, as billed by Datastore
+NEW_ENTITY_WRITES = 2
+NEW_BUILTIN_WRITES = 2      # per indexed property value (asc + desc)
+NEW_COMPOSITE_WRITES = 1    # per composite index row
+UPDATE_ENTITY_WRITES = 1
+UPDATE_BUILTIN_WRITES = 4   # per modified indexed property value
+UPDATE_COMPOSITE_WRITES = 2  # per modified composite index row
+
+HEADER = """indexes:
+
+# Curated by tools/index_advisor.py; this file is no longer updated by the
+# dev server. Conference indexes below the marker line are generated from
+# the query shapes of queryConferences; add other indexes above it and
+# re-run the advisor after changing _get_query() or FIELDS.
+
+"""
+GENERATED_MARKER = '# - - - generated Conference indexes - - -'
+
+
+def load_fields():
+    """Read the FIELDS dict literal from conference.py without importing
+    it, so the App Engine SDK isn't needed."""
+    with open(os.path.join(APP_DIR, 'conference.py')) as f:
+        tree = ast.parse(f.read())
+    for node in tree.body:
+        if (isinstance(node, ast.Assign) and
+                getattr(node.targets[0], 'id', None) == 'FIELDS'):
+            return sorted(ast.literal_eval(node.value).values())
+    raise ValueError('FIELDS not found in conference.py')
+
+
+def query_shapes(fields):
+    """Yield (equality fields, inequality field or None) for every query
+    _get_query() can build."""
+    for inequality in [None] + fields:
+        rest = [f for f in fields if f != inequality]
+        for n in range(len(rest) + 1):
+            for equalities in itertools.combinations(rest, n):
+                if equalities or inequality:
+                    yield equalities, inequality
+
+
+def suffix(inequality):
+    return (inequality, SORT) if inequality else (SORT,)
+
+
+def exact_index(equalities, inequality):
+    return tuple(equalities) + suffix(inequality)
+
+
+def merge_indexes(equalities, inequality):
+    """Indexes a zigzag merge join needs for one query shape."""
+    if not equalities:
+        return [suffix(inequality)]
+    return [(field,) + suffix(inequality) for field in equalities]
+
+
+def needs_composite(index):
+    # a single property sorted ascending is served by the built-in index
+    return len(index) > 1
+
+
+def propose(fields, exact=False):
+    """Return {shape: [indexes]} and the sorted set of indexes needed."""
+    plan = {}
+    for shape in query_shapes(fields):
+        if exact:
+            plan[shape] = [exact_index(*shape)]
+        else:
+            plan[shape] = merge_indexes(*shape)
+    indexes = set(index for needed in plan.values() for index in needed
+                  if needs_composite(index))
+    return plan, sorted(indexes, key=lambda i: (len(i), i))
+
+
+# - - - index.yaml - - - - - - - - - - - - - - - - - - - - - - -
+
+def parse_index_yaml(path):
+    """Parse index.yaml into dicts with kind, ancestor and properties
+    [(name, direction)]. Only the subset of YAML that file uses."""
+    indexes = []
+    current = None
+    with open(path) as f:
+        for line in f:
+            text = line.split('#', 1)[0].strip()
+            if text.startswith('- kind:'):
+                current = {'kind': text.split(':', 1)[1].strip(),
+                           'ancestor': False, 'properties': []}
+                indexes.append(current)
+            elif current is None:
+                continue
+            elif text.startswith('ancestor:'):
+                current['ancestor'] = text.split(':', 1)[1].strip() == 'yes'
+            elif text.startswith('- name:'):
+                current['properties'].append(
+                    [text.split(':', 1)[1].strip(), 'asc'])
+            elif text.startswith('direction:'):
+                current['properties'][-1][1] = text.split(':', 1)[1].strip()
+    return indexes
+
+
+def is_generated(index, fields):
+    """True for Conference indexes that only serve queryConferences."""
+    names = [name for name, direction in index['properties']]
+    return (index['kind'] == KIND and not index['ancestor'] and
+            names[-1:] == [SORT] and
+            all(direction == 'asc' for _, direction in index['properties'])
+            and set(names[:-1]) <= set(fields))
+
+
+def format_index(index):
+    lines = ['- kind: %s' % index['kind']]
+    if index['ancestor']:
+        lines.append('  ancestor: yes')
+    lines.append('  properties:')
+    for name, direction in index['properties']:
+        lines.append('  - name: %s' % name)
+        if direction != 'asc':
+            lines.append('    direction: %s' % direction)
+    return '\n'.join(lines) + '\n'
+
+
+def write_index_yaml(path, kept, proposed):
+    with open(path, 'w') as f:
+        f.write(HEADER)
+        for index in kept:
+            f.write(format_index(index) + '\n')
+        f.write(GENERATED_MARKER + '\n\n')
+        f.write('\n'.join(
+            format_index({'kind': KIND, 'ancestor': False,
+                          'properties': [[p, 'asc'] for p in index]})
+            for index in proposed))
+
+
+# - - - write amplification - - - - - - - - - - - - - - - - - - -
+
+def index_rows(index, topics):
+    """Rows one Conference with that many topics has in an index."""
+    rows = 1
+    for prop in index:
+        if prop in REPEATED:
+            rows *= topics
+    return rows
+
+
+def new_entity_writes(composites, topics):
+    builtin = len(INDEXED_PROPERTIES) - len(REPEATED) + topics
+    return (NEW_ENTITY_WRITES + NEW_BUILTIN_WRITES * builtin +
+            NEW_COMPOSITE_WRITES * sum(index_rows(i, topics)
+                                       for i in composites))
+
+
+def update_writes(composites, topics, changed):
+    """Writes for a put() that modifies only the changed properties."""
+    builtin = sum(topics if p in REPEATED else 1 for p in changed)
+    return (UPDATE_ENTITY_WRITES + UPDATE_BUILTIN_WRITES * builtin +
+            UPDATE_COMPOSITE_WRITES * sum(
+                index_rows(i, topics) for i in composites
+                if set(i) & set(changed)))
+
+
+def report(fields, current, plan, proposed, out=sys.stdout):
+    out.write('%d query shapes over %s, sorted by %s\n\n'
+              % (len(plan), ', '.join(fields), SORT))
+    out.write('%-50s %s\n' % ('filters (= / inequality)', 'indexes'))
+    for (equalities, inequality), indexes in sorted(
+            plan.items(), key=lambda i: (i[0][1] or '', i[0][0])):
+        shape = '%s / %s' % (','.join(equalities) or '-', inequality or '-')
+        out.write('%-50s %s\n' % (shape, ' + '.join(
+            '(%s)' % ','.join(i) for i in indexes)))
+
+    out.write('\ncomposite Conference indexes: %d current, %d proposed\n'
+              % (len(current), len(proposed)))
+    uncovered = [shape for shape, indexes in plan.items()
+                 if not all(i in current or not needs_composite(i)
+                            for i in indexes) and
+                 exact_index(*shape) not in current]
+    out.write('query shapes the current indexes cannot serve: %d\n\n'
+              % len(uncovered))
+
+    out.write('index writes per Conference.put()\n')
+    out.write('%-42s %9s %9s\n' % ('', 'current', 'proposed'))
+    for topics in (1, 2, 4):
+        out.write('%-42s %9d %9d\n' % (
+            'new conference, %d topic(s)' % topics,
+            new_entity_writes(current, topics),
+            new_entity_writes(proposed, topics)))
+    for topics in (1, 2, 4):
+        changed = ('seatsAvailable', 'updated')
+        out.write('%-42s %9d %9d\n' % (
+            'seat change, %d topic(s)' % topics,
+            update_writes(current, topics, changed),
+            update_writes(proposed, topics, changed)))
+    for topics in (2, 4):
+        changed = ('city', 'updated')
+        out.write('%-42s %9d %9d\n' % (
+            'city change, %d topic(s)' % topics,
+            update_writes(current, topics, changed),
+            update_writes(proposed, topics, changed)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[2])
+    parser.add_argument('--index-yaml',
+                        default=os.path.join(APP_DIR, 'index.yaml'))
+    parser.add_argument('--exact', action='store_true',
+                        help='one exact index per query shape, no merge joins')
+    parser.add_argument('--write', action='store_true',
+                        help='rewrite index.yaml with the proposed indexes')
+    args = parser.parse_args(argv)
+
+    fields = load_fields()
+    existing = parse_index_yaml(args.index_yaml)
+    generated = [e for e in existing if is_generated(e, fields)]
+    kept = [e for e in existing if not is_generated(e, fields)]
+    current_composites = [tuple(name for name, _ in e['properties'])
+                          for e in existing if e['kind'] == KIND]
+
+    plan, proposed = propose(fields, args.exact)
+    # indexes kept by hand still cost writes
+    kept_composites = [tuple(name for name, _ in e['properties'])
+                       for e in kept if e['kind'] == KIND]
+    report(fields, current_composites, plan, proposed + kept_composites)
+
+    if args.write:
+        write_index_yaml(args.index_yaml, kept, proposed)
+        sys.stdout.write('\nwrote %s: %d generated indexes replaced by %d\n'
+                         % (args.index_yaml, len(generated), len(proposed)))
+
+
+if __name__ == '__main__':
+    main()
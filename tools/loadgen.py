@@ -0,0 +1,540 @@
+#!/usr/bin/env python
+
+"""loadgen.py
+
+Record, generate and replay ConferenceApi call traces against a local
+    dev server, reporting throughput, latency percentiles and error and
+    contention rates per API method
+
+Traces are JSON lines {"method", "params", "user", "ts"}. They come from
+the TRACE lines logged by instrumentation.py when TRACE_API_CALLS is set
+(point --trace at a downloaded request log), or from the synthetic
+generators below.
+
+    # record a synthetic mix, then replay it at 20 workers, 50 req/s
+    python tools/loadgen.py synthetic --calls 5000 --conference KEY \\
+        --record mix.jsonl
+    python tools/loadgen.py replay --trace mix.jsonl -c 20 --rate 50
+
+    # flash sale: 2000 users register for one conference at once
+    python tools/loadgen.py flash-sale --conference KEY --users 2000 -c 100
+
+    # cold start: import time of the app modules in 10 fresh interpreters
+    python tools/loadgen.py coldstart --sdk ~/google_appengine --runs 10
+
+    # seed 500 conferences with 40 sessions each, then page through the
+    # long queries, following websafeCursor until it runs out
+    python tools/loadgen.py seed --calls 500 --sessions 40 --tokens t.json
+    python tools/loadgen.py paged --tokens t.json
+
+$Id$
+
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+
+try:
+    from urllib2 import Request, urlopen, HTTPError, URLError
+    from urllib import quote, urlencode
+    import Queue as queue
+except ImportError:
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError, URLError
+    from urllib.parse import quote, urlencode
+    import queue
+
+TRACE_PREFIX = 'TRACE '
+API_ROOT = '/_ah/api'
+DISCOVERY_PATH = '/discovery/v1/apis/conference/v1/rest'
+
+# status codes counted as contention rather than plain errors: 409 is
+# ConflictException (e.g. sold out), 503 is what a failed transaction
+# retry surfaces as through Endpoints
+CONTENTION_STATUSES = (409, 503)
+# a 503 whose message starts with this is the rate limiter's, counted
+# as throttled
+THROTTLED_MESSAGE = 'Too many'
+
+SYNTHETIC_MIX = [
+    # (weight, method)
+    (30, 'queryConferences'),
+    (20, 'getConferenceDetail'),
+    (10, 'getConference'),
+    (10, 'getConferenceSessions'),
+    (10, 'getAnnouncement'),
+    (5, 'getFeaturedSpeaker'),
+    (5, 'getProfile'),
+    (5, 'registerForConference'),
+    (5, 'unregisterFromConference'),
+]
+
+SESSION_TYPES = ['lecture', 'keynote', 'workshop', 'panel']
+# seeding backs off and retries calls refused with 503 (throttled or
+# contended) this many times, starting at SEED_BACKOFF seconds
+SEED_RETRIES = 8
+SEED_BACKOFF = 0.5
+# most sessions createSessions accepts per call (CREATE_SESSIONS_LIMIT)
+SEED_SESSIONS_PER_CALL = 50
+# (method, params) walked by the paged mode
+PAGED_QUERIES = [
+    ('queryConferences', {'filters': []}),
+    ('getSessionsNonWorkshopBeforeSeven', {}),
+    ('getSessionsBySpeaker', {'speaker': 'speaker0'}),
+]
+
+CITIES = ['Chicago', 'London', 'Paris', 'San Francisco', 'Tokyo']
+TOPICS = ['Medical Innovations', 'Programming Languages', 'Web Technologies',
+          'Movie Making', 'Health and Nutrition']
+
+
+# - - - Traces - - - - - - - - - - - - - - - - - - - - - - - - -
+
+def load_traces(path):
+    """Read traces from a JSON lines file or from request log lines."""
+    traces = []
+    with open(path) as f:
+        for line in f:
+            if TRACE_PREFIX in line:
+                line = line[line.index(TRACE_PREFIX) + len(TRACE_PREFIX):]
+            line = line.strip()
+            if line.startswith('{'):
+                traces.append(json.loads(line))
+    traces.sort(key=lambda t: t.get('ts') or 0)
+    return traces
+
+
+def save_traces(traces, path):
+    with open(path, 'w') as f:
+        for trace in traces:
+            f.write(json.dumps(trace) + '\n')
+
+
+def _random_filters(rnd):
+    filters = []
+    if rnd.random() < 0.5:
+        filters.append({'field': 'CITY', 'operator': 'EQ',
+                        'value': rnd.choice(CITIES)})
+    if rnd.random() < 0.3:
+        filters.append({'field': 'TOPIC', 'operator': 'EQ',
+                        'value': rnd.choice(TOPICS)})
+    if rnd.random() < 0.3:
+        filters.append({'field': 'MONTH', 'operator': 'EQ',
+                        'value': str(rnd.randint(1, 12))})
+    return {'filters': filters}
+
+
+def synthetic_traces(calls, conferences, users, seed=None):
+    """Generate a read heavy mix of calls spread over the conferences."""
+    rnd = random.Random(seed)
+    methods = []
+    for weight, method in SYNTHETIC_MIX:
+        methods.extend([method] * weight)
+
+    traces = []
+    for i in range(calls):
+        method = rnd.choice(methods)
+        if method == 'queryConferences':
+            params = _random_filters(rnd)
+        elif method in ('getAnnouncement', 'getFeaturedSpeaker',
+                        'getProfile'):
+            params = {}
+        else:
+            params = {'websafeConferenceKey': rnd.choice(conferences)}
+        traces.append({'method': method, 'params': params,
+                       'user': 'user%d@example.com' % rnd.randrange(users),
+                       'ts': i})
+    return traces
+
+
+def flash_sale_traces(conference, users):
+    """Every user registers for the same conference at the same instant,
+    like the opening of registration for a popular event."""
+    return [{'method': 'registerForConference',
+             'params': {'websafeConferenceKey': conference},
+             'user': 'user%d@example.com' % i,
+             'ts': 0}
+            for i in range(users)]
+
+
+# - - - Replay - - - - - - - - - - - - - - - - - - - - - - - - -
+
+def load_routes(base_url):
+    """Map API method names to (httpMethod, path, path params) using the
+    discovery document, so new endpoints need no changes here."""
+    doc = json.loads(urlopen(base_url + API_ROOT + DISCOVERY_PATH).read())
+    routes = {}
+
+    def walk(node):
+        for method in node.get('methods', {}).values():
+            name = method['id'].split('.')[-1]
+            path_params = [p for p, spec in
+                           method.get('parameters', {}).items()
+                           if spec.get('location') == 'path']
+            routes[name] = (method['httpMethod'],
+                            doc['servicePath'] + method['path'],
+                            path_params)
+        for child in node.get('resources', {}).values():
+            walk(child)
+
+    walk(doc)
+    return routes
+
+
+class Stats(object):
+    """Stats -- latencies and outcomes per method, shared by workers"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.contention = {}
+        self.throttled = {}
+
+    def record(self, method, seconds, status, throttled=False):
+        with self.lock:
+            self.latencies.setdefault(method, []).append(seconds)
+            if throttled:
+                self.throttled[method] = self.throttled.get(method, 0) + 1
+            elif status in CONTENTION_STATUSES:
+                self.contention[method] = self.contention.get(method, 0) + 1
+            elif status >= 400:
+                self.errors[method] = self.errors.get(method, 0) + 1
+
+
+def is_throttled(error):
+    """True if the HTTPError is the rate limiter turning a call away."""
+    if error.code != 503:
+        return False
+    try:
+        body = json.loads(error.read().decode('utf-8'))
+    except ValueError:
+        return False
+    return body.get('error', {}).get('message', '').startswith(
+        THROTTLED_MESSAGE)
+
+
+def percentile(values, pct):
+    """Nearest rank percentile of an already sorted list."""
+    if not values:
+        return 0.0
+    rank = int(math.ceil(pct / 100.0 * len(values))) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+
+class Replayer(object):
+    """Replayer -- sends traces from a pool of worker threads, released
+    at most rate calls per second."""
+
+    def __init__(self, base_url, concurrency=10, rate=0, tokens=None,
+                 timeout=60):
+        self.base_url = base_url.rstrip('/')
+        self.concurrency = concurrency
+        self.rate = rate
+        self.tokens = tokens or {}
+        self.timeout = timeout
+        self.routes = load_routes(self.base_url)
+        self.stats = Stats()
+
+    def _request(self, trace):
+        verb, path, path_params = self.routes[trace['method']]
+        params = dict(trace.get('params') or {})
+        for name in path_params:
+            path = path.replace('{%s}' % name,
+                                quote(str(params.pop(name, '')), safe=''))
+        url = self.base_url + API_ROOT + '/' + path
+
+        body = None
+        if verb in ('POST', 'PUT'):
+            body = json.dumps(params).encode('utf-8')
+        elif params:
+            url += '?' + urlencode(params, doseq=True)
+
+        req = Request(url, data=body)
+        req.get_method = lambda: verb
+        req.add_header('Content-Type', 'application/json')
+        token = self.tokens.get(trace.get('user')) or self.tokens.get('*')
+        if token:
+            req.add_header('Authorization', 'Bearer %s' % token)
+        return req
+
+    def call(self, method, params=None, user=None):
+        """Make one call and return (status, parsed JSON response or
+        None); for setup and paging rather than load."""
+        req = self._request({'method': method, 'params': params or {},
+                             'user': user})
+        try:
+            resp = urlopen(req, timeout=self.timeout)
+            return resp.getcode(), json.loads(resp.read().decode('utf-8'))
+        except HTTPError as e:
+            return e.code, None
+
+    def _send(self, trace):
+        req = self._request(trace)
+        started = time.time()
+        throttled = False
+        try:
+            resp = urlopen(req, timeout=self.timeout)
+            resp.read()
+            status = resp.getcode()
+        except HTTPError as e:
+            status = e.code
+            throttled = is_throttled(e)
+        except URLError:
+            status = 599
+        self.stats.record(trace['method'], time.time() - started, status,
+                          throttled)
+
+    def _worker(self, work):
+        while True:
+            trace = work.get()
+            if trace is None:
+                return
+            try:
+                self._send(trace)
+            except KeyError:
+                # method unknown to this server, count it as an error
+                self.stats.record(trace['method'], 0.0, 404)
+
+    def run(self, traces):
+        """Replay the traces; return the wall clock time taken."""
+        work = queue.Queue(maxsize=self.concurrency * 2)
+        workers = [threading.Thread(target=self._worker, args=(work,))
+                   for _ in range(self.concurrency)]
+        for w in workers:
+            w.daemon = True
+            w.start()
+
+        started = time.time()
+        interval = 1.0 / self.rate if self.rate else 0
+        for i, trace in enumerate(traces):
+            if interval:
+                delay = started + i * interval - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            work.put(trace)
+        for _ in workers:
+            work.put(None)
+        for w in workers:
+            w.join()
+        return time.time() - started
+
+
+def report(stats, elapsed, out=sys.stdout):
+    """Print throughput, latency percentiles and error rates per method."""
+    total = sum(len(v) for v in stats.latencies.values())
+    out.write('%d calls in %.1fs, %.1f calls/s\n\n'
+              % (total, elapsed, total / elapsed if elapsed else 0))
+    out.write('%-36s %7s %8s %8s %8s %8s %7s %7s %7s\n' % (
+        'method', 'calls', 'rps', 'p50 ms', 'p95 ms', 'p99 ms',
+        'err %', 'cont %', 'thr %'))
+    for method in sorted(stats.latencies):
+        lat = sorted(stats.latencies[method])
+        n = len(lat)
+        out.write('%-36s %7d %8.1f %8.1f %8.1f %8.1f %7.2f %7.2f %7.2f\n' % (
+            method, n, n / elapsed if elapsed else 0,
+            percentile(lat, 50) * 1000, percentile(lat, 95) * 1000,
+            percentile(lat, 99) * 1000,
+            100.0 * stats.errors.get(method, 0) / n,
+            100.0 * stats.contention.get(method, 0) / n,
+            100.0 * stats.throttled.get(method, 0) / n))
+
+
+# - - - Seeding and paging - - - - - - - - - - - - - - - - - -
+
+def _call_with_backoff(replayer, method, params=None):
+    """Make one call, retrying with exponential backoff while it's
+    refused with 503; raise RuntimeError if it fails."""
+    delay = SEED_BACKOFF
+    for _ in range(SEED_RETRIES):
+        status, body = replayer.call(method, params)
+        if status != 503:
+            break
+        time.sleep(delay)
+        delay *= 2
+    if status != 200:
+        raise RuntimeError('%s failed: %d' % (method, status))
+    return body
+
+
+def seed(replayer, conferences, sessions, speakers=20, seed=None,
+         out=sys.stdout):
+    """Create conferences with random city, topic and month, and
+    sessions with random speaker, type and start time, as the user whose
+    token is "*"."""
+    rnd = random.Random(seed)
+    for i in range(conferences):
+        month = rnd.randint(1, 12)
+        _call_with_backoff(replayer, 'createConference', {
+            'name': 'Seeded conference %d' % i,
+            'city': rnd.choice(CITIES),
+            'topics': [rnd.choice(TOPICS)],
+            'startDate': '2030-%02d-01' % month,
+            'endDate': '2030-%02d-03' % month,
+            'maxAttendees': rnd.randint(10, 500),
+        })
+
+    created = _call_with_backoff(replayer, 'getConferencesCreated')
+    keys = [conf['websafeKey'] for conf in created.get('items', [])]
+    for key in keys:
+        items = [{'name': 'Session %d' % j,
+                  'speaker': 'speaker%d' % rnd.randrange(speakers),
+                  'typeOfSession': rnd.choice(SESSION_TYPES),
+                  'date': '2030-01-01',
+                  'startTime': '%02d:%02d' % (rnd.randint(8, 21),
+                                              rnd.choice((0, 30))),
+                  'duration': rnd.choice((0.5, 1.0, 1.5))}
+                 for j in range(sessions)]
+        for start in range(0, len(items), SEED_SESSIONS_PER_CALL):
+            _call_with_backoff(replayer, 'createSessions', {
+                'websafeConferenceKey': key,
+                'items': items[start:start + SEED_SESSIONS_PER_CALL]})
+    out.write('seeded %d conferences, %d sessions\n'
+              % (len(keys), len(keys) * sessions))
+
+
+def paged(replayer, queries=PAGED_QUERIES, out=sys.stdout):
+    """Walk each query to the end through websafeCursor; report the
+    pages, items and partial (cut short by the deadline) pages, and the
+    latency per page."""
+    out.write('%-36s %6s %8s %8s %8s %8s\n' % (
+        'method', 'pages', 'items', 'partial', 'p50 ms', 'max ms'))
+    for method, params in queries:
+        params = dict(params)
+        pages = items = partial = 0
+        latencies = []
+        while True:
+            started = time.time()
+            status, body = replayer.call(method, params)
+            latencies.append(time.time() - started)
+            if status != 200:
+                out.write('%-36s failed with %d\n' % (method, status))
+                break
+            pages += 1
+            items += len(body.get('items', []))
+            cursor = body.get('websafeCursor')
+            if not cursor:
+                break
+            partial += 1
+            params['websafeCursor'] = cursor
+        latencies.sort()
+        out.write('%-36s %6d %8d %8d %8.1f %8.1f\n' % (
+            method, pages, items, partial,
+            percentile(latencies, 50) * 1000, latencies[-1] * 1000))
+
+
+# - - - Cold start - - - - - - - - - - - - - - - - - - - - - - -
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# run in a fresh interpreter, so nothing is imported yet; prints the
+# milliseconds spent importing each module the way a new instance does
+COLDSTART_SCRIPT = """
+import json, sys, time
+sys.path.insert(0, %(sdk)r)
+import dev_appserver
+dev_appserver.fix_sys_path()
+sys.path.insert(0, %(app)r)
+timings = {}
+for module in ('conference', 'main'):
+    started = time.time()
+    __import__(module)
+    timings[module] = (time.time() - started) * 1000
+print(json.dumps(timings))
+"""
+
+
+def coldstart(sdk, runs, out=sys.stdout):
+    """Report p50/p95 import time of the API and handler modules."""
+    script = COLDSTART_SCRIPT % {'sdk': os.path.expanduser(sdk),
+                                 'app': APP_DIR}
+    samples = {}
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, '-c', script])
+        timings = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+        for module, ms in timings.items():
+            samples.setdefault(module, []).append(ms)
+
+    out.write('%-36s %7s %8s %8s\n' % ('module', 'runs', 'p50 ms', 'p95 ms'))
+    for module in sorted(samples):
+        ms = sorted(samples[module])
+        out.write('%-36s %7d %8.1f %8.1f\n' % (
+            module, len(ms), percentile(ms, 50), percentile(ms, 95)))
+
+
+# - - - Command line - - - - - - - - - - - - - - - - - - - - - -
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[2])
+    parser.add_argument('mode', choices=['replay', 'synthetic', 'flash-sale',
+                                         'coldstart', 'seed', 'paged'])
+    parser.add_argument('--url', default='http://localhost:8080')
+    parser.add_argument('--trace', help='trace or request log file to replay')
+    parser.add_argument('--record', help='write the traces to this file '
+                                         'instead of replaying them')
+    parser.add_argument('--conference', action='append', default=[],
+                        help='websafeConferenceKey used by the generators')
+    parser.add_argument('--calls', type=int, default=1000,
+                        help='calls to generate, or conferences to seed')
+    parser.add_argument('--sessions', type=int, default=20,
+                        help='sessions per seeded conference')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('-c', '--concurrency', type=int, default=10)
+    parser.add_argument('--rate', type=float, default=0,
+                        help='max calls per second, 0 for unlimited')
+    parser.add_argument('--tokens', help='JSON file mapping user to OAuth '
+                                         'bearer token, "*" for everyone')
+    parser.add_argument('--sdk', help='App Engine Python SDK directory')
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args(argv)
+
+    if args.mode == 'coldstart':
+        if not args.sdk:
+            parser.error('coldstart needs --sdk')
+        coldstart(args.sdk, args.runs)
+        return
+    elif args.mode in ('seed', 'paged'):
+        if not args.tokens:
+            parser.error('%s needs --tokens' % args.mode)
+        with open(args.tokens) as f:
+            replayer = Replayer(args.url, tokens=json.load(f))
+        if args.mode == 'seed':
+            seed(replayer, args.calls, args.sessions, seed=args.seed)
+        else:
+            paged(replayer)
+        return
+    elif args.mode == 'replay':
+        if not args.trace:
+            parser.error('replay needs --trace')
+        traces = load_traces(args.trace)
+    elif not args.conference:
+        parser.error('%s needs --conference' % args.mode)
+    elif args.mode == 'synthetic':
+        traces = synthetic_traces(args.calls, args.conference, args.users,
+                                  args.seed)
+    else:
+        traces = flash_sale_traces(args.conference[0], args.users)
+
+    if args.record:
+        save_traces(traces, args.record)
+        return
+
+    tokens = None
+    if args.tokens:
+        with open(args.tokens) as f:
+            tokens = json.load(f)
+    replayer = Replayer(args.url, args.concurrency, args.rate, tokens)
+    elapsed = replayer.run(traces)
+    report(replayer.stats, elapsed)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,7 +3,6 @@ import os
 import time
 import uuid
 
-from google.appengine.api import urlfetch
 from models import Profile
 
 
@@ -13,6 +12,8 @@ def get_user_id(user, id_type="email"):
 
     if id_type == "oauth":
         """A workaround implementation for getting userid."""
+        # deferred, the default "email" id type never needs urlfetch
+        from google.appengine.api import urlfetch
         auth = os.getenv('HTTP_AUTHORIZATION')
         bearer, token = auth.split()
         token_type = 'id_token'